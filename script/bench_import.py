@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Measures the import cost every hook dispatch pays before a handler runs.
+
+Each scenario is run in a fresh interpreter, as Juju does for every hook, and
+reports the median wall time and peak RSS of the import:
+
+    PYTHONPATH=lib:src python3 script/bench_import.py [--runs N]
+
+The `kubernetes.client` scenario is what the charm paid on every hook when it
+imported the generated client at module level.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    "charm": "import charm",
+    "charm + k8s request path": "import charm, urllib3",
+    "kubernetes.client": "import ops.main, kubernetes.client",
+}
+
+PROBE = """
+import json, resource, time
+start = time.perf_counter()
+{stmt}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+
+def measure(stmt: str, runs: int) -> dict:
+    """Returns the median import time and RSS of a statement in fresh interpreters"""
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(stmt = stmt)],
+            check = True, capture_output = True, text = True,
+        )
+        samples.append(json.loads(out.stdout))
+    return {
+        "ms": round(statistics.median(s["seconds"] for s in samples) * 1000, 1),
+        "maxrss_mb": round(statistics.median(s["maxrss_kb"] for s in samples) / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--runs", type = int, default = 5)
+    args = parser.parse_args()
+    for name, stmt in SCENARIOS.items():
+        try:
+            result = measure(stmt, args.runs)
+        except subprocess.CalledProcessError:
+            print(f"{name:28} unavailable")
+            continue
+        print(f"{name:28} {result['ms']:8.1f} ms {result['maxrss_mb']:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Streaming backup and restore of the Portainer data directory.
+
+Files move between the workload container and a gzip tarball in the charm
+container through Pebble's file API, one chunk at a time, so memory use does
+not depend on the size of the database. Every archive ends with a SHA256SUMS
+member checked before anything is restored. Each Pebble call is made within
+timed(name), a context manager the caller may pass to record how long it took.
+"""
+
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import tempfile
+import time
+
+from ops import pebble
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# files bigger than this are spooled to disk instead of memory
+SPOOL_MAX_MEMORY = 8 * CHUNK_SIZE
+CHECKSUMS_NAME = "SHA256SUMS"
+# the BoltDB store, only consistent while Portainer is stopped
+DATABASE_NAME = "portainer.db"
+
+
+class BackupError(Exception):
+    """Raised when an archive can't be created or restored"""
+
+
+class _HashingWriter(io.RawIOBase):
+    """Writable stream forwarding to a file while hashing what goes through"""
+
+    def __init__(self, target):
+        self.target = target
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.target.write(data)
+
+
+def _walk(container, directory: str, timed):
+    """Yields the FileInfo of every file and directory under directory in the container"""
+    with timed("list_files"):
+        infos = container.list_files(directory)
+    for info in infos:
+        yield info
+        if info.type == pebble.FileType.DIRECTORY:
+            yield from _walk(container, info.path, timed)
+
+
+def _spool(container, path: str, timed):
+    """Copies a file out of the container in chunks, returns the spooled copy and its sha256"""
+    spool = tempfile.SpooledTemporaryFile(max_size = SPOOL_MAX_MEMORY)
+    sha256 = hashlib.sha256()
+    # the file streams in while it is read, so the reads count towards the pull
+    with timed("pull"), container.pull(path, encoding = None) as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            spool.write(chunk)
+    spool.seek(0)
+    return spool, sha256.hexdigest()
+
+
+def _add_spooled(archive: tarfile.TarFile, name: str, spool, permissions: int, mtime: float = None):
+    """Adds a spooled file to the archive under name"""
+    spool.seek(0, os.SEEK_END)
+    member = tarfile.TarInfo(name)
+    member.size = spool.tell()
+    member.mode = permissions
+    member.mtime = int(mtime or time.time())
+    spool.seek(0)
+    archive.addfile(member, spool)
+
+
+def _write_archive(container, data_dir: str, destination: str, quiesce, checksums: dict, timed) -> dict:
+    """Writes the gzip tarball of data_dir to destination, filling checksums by member name;
+    returns the size, sha256 and downtime of the archive"""
+    database = None
+    downtime = 0.0
+    with open(destination, "wb") as target:
+        writer = _HashingWriter(target)
+        with tarfile.open(fileobj = writer, mode = "w|gz") as archive:
+            for info in _walk(container, data_dir, timed):
+                name = os.path.relpath(info.path, data_dir)
+                if info.type == pebble.FileType.DIRECTORY:
+                    member = tarfile.TarInfo(name)
+                    member.type = tarfile.DIRTYPE
+                    member.mode = info.permissions
+                    member.mtime = int(info.last_modified.timestamp())
+                    archive.addfile(member)
+                elif info.type == pebble.FileType.FILE:
+                    if name == DATABASE_NAME:
+                        database = info
+                        continue
+                    spool, checksums[name] = _spool(container, info.path, timed)
+                    with spool:
+                        _add_spooled(archive, name, spool, info.permissions, info.last_modified.timestamp())
+            if database is not None:
+                quiesced = time.monotonic()
+                with quiesce():
+                    spool, checksums[DATABASE_NAME] = _spool(container, database.path, timed)
+                downtime = time.monotonic() - quiesced
+                with spool:
+                    _add_spooled(archive, DATABASE_NAME, spool, database.permissions,
+                        database.last_modified.timestamp())
+            sums = "".join(f"{digest}  {name}\n" for name, digest in sorted(checksums.items()))
+            with io.BytesIO(sums.encode("utf-8")) as spool:
+                _add_spooled(archive, CHECKSUMS_NAME, spool, 0o644)
+    return {"size": writer.size, "sha256": writer.sha256.hexdigest(), "downtime": downtime}
+
+
+def backup(container, data_dir: str, destination: str, quiesce, timed = contextlib.nullcontext) -> dict:
+    """Archives data_dir of the container into a gzip tarball at destination.
+
+    Everything but the database is copied while Portainer keeps running; quiesce is a
+    context manager stopping it while the database alone is spooled out, so the downtime
+    is the raw transfer of that one file. Returns figures about the archive.
+    """
+    started = time.monotonic()
+    checksums = {}
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok = True)
+    # written under a temporary name, so a failed backup never leaves a truncated archive behind
+    partial = f"{destination}.partial"
+    try:
+        written = _write_archive(container, data_dir, partial, quiesce, checksums, timed)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+    os.replace(partial, destination)
+    return {
+        "path": destination,
+        "size": written["size"],
+        "sha256": written["sha256"],
+        "files": len(checksums),
+        "downtime": round(written["downtime"], 3),
+        "duration": round(time.monotonic() - started, 3),
+    }
+
+
+def _sha256_file(path: str) -> str:
+    """Returns the sha256 of a local file, read in chunks"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _check_member(source: str, member: tarfile.TarInfo):
+    """Raises BackupError unless member is a file or directory restorable inside the data directory"""
+    if os.path.isabs(member.name) or os.path.normpath(member.name).split(os.sep)[0] == "..":
+        raise BackupError(f"{source} member {member.name} escapes the data directory")
+    if not (member.isfile() or member.isdir()):
+        raise BackupError(f"{source} member {member.name} isn't a file or directory")
+
+
+def verify(source: str, sha256: str = None) -> dict:
+    """Checks every member of the archive at source against its SHA256SUMS, and the archive
+    itself against sha256 if given; returns the checksums by member name. Archives with
+    members restore couldn't place inside the data directory are rejected too."""
+    if sha256 and _sha256_file(source) != sha256:
+        raise BackupError(f"{source} doesn't match sha256 {sha256}")
+    digests = {}
+    expected = None
+    try:
+        with tarfile.open(source, mode = "r|gz") as archive:
+            for member in archive:
+                _check_member(source, member)
+                if not member.isfile():
+                    continue
+                content = archive.extractfile(member)
+                if member.name == CHECKSUMS_NAME:
+                    expected = {}
+                    for line in content.read().decode("utf-8").splitlines():
+                        digest, _, name = line.partition("  ")
+                        expected[name] = digest
+                    continue
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: content.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                digests[member.name] = digest.hexdigest()
+    except (tarfile.TarError, EOFError) as e:
+        raise BackupError(f"{source} isn't a readable archive: {e}") from e
+    if expected is None:
+        raise BackupError(f"{source} has no {CHECKSUMS_NAME}, it isn't a portainer backup")
+    mismatched = sorted(
+        name for name in expected.keys() | digests.keys()
+        if expected.get(name) != digests.get(name)
+    )
+    if mismatched:
+        raise BackupError(f"{source} is corrupted, checksums differ for: {', '.join(mismatched)}")
+    return digests
+
+
+def restore(container, data_dir: str, source: str, quiesce, sha256: str = None,
+        timed = contextlib.nullcontext) -> dict:
+    """Replaces data_dir of the container with the content of the archive at source.
+
+    The archive, including the names and types of its members, is verified before
+    Portainer is touched; quiesce is a context manager
+    stopping it while the old files are removed and the archived ones pushed. Pebble
+    can't rename, so the files can't be staged and swapped in: a failure part way leaves
+    data_dir incomplete, and quiesce must then keep Portainer stopped.
+    """
+    started = time.monotonic()
+    digests = verify(source, sha256)
+    quiesced = time.monotonic()
+    with quiesce():
+        with timed("list_files"):
+            infos = container.list_files(data_dir)
+        for info in infos:
+            with timed("remove_path"):
+                container.remove_path(info.path, recursive = True)
+        with tarfile.open(source, mode = "r|gz") as archive:
+            for member in archive:
+                path = os.path.join(data_dir, member.name)
+                if member.isdir():
+                    with timed("make_dir"):
+                        container.make_dir(path, make_parents = True, permissions = member.mode)
+                elif member.isfile() and member.name != CHECKSUMS_NAME:
+                    with timed("push"):
+                        container.push(path, archive.extractfile(member), make_dirs = True, permissions = member.mode)
+    return {
+        "path": source,
+        "files": len(digests),
+        "downtime": round(time.monotonic() - quiesced, 3),
+        "duration": round(time.monotonic() - started, 3),
+    }
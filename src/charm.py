@@ -2,23 +2,58 @@
 # Copyright 2021 Portainer
 # See LICENSE file for licensing details.
 
+import backup
+import concurrent.futures
+import contextlib
+import database
+import functools
+import instrumentation
+import json
+import k8s
 import logging
+import math
+import metrics
+import os
+import re
+import state
 import utils
 import sys
+import threading
+import time
 
-from kubernetes import kubernetes
 from ops.charm import CharmBase
-from ops.framework import StoredState
+from ops.framework import Handle, StoredState
+from ops import pebble
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 
 # disable bytecode caching according to: https://discourse.charmhub.io/t/upgrading-a-charm/1131
 sys.dont_write_bytecode = True
 logger = logging.getLogger(__name__)
-# Reduce the log output from the Kubernetes library
-# logging.getLogger("kubernetes").setLevel(logging.INFO)
 CHARM_VERSION = 1.0
 CONTAINER_NAME = "portainer"
+DATA_DIR = "/data"
+BACKUP_DIR = "/var/lib/portainer/backups"
+# counters and rendered metrics of the charm, served by the exporter
+METRICS_DIR = "/var/lib/portainer/metrics"
+METRICS_RELATION = "metrics-endpoint"
+INGRESS_RELATION = "ingress"
+DATABASE_PATH = os.path.join(DATA_DIR, backup.DATABASE_NAME)
+HTTP_PORT = 9000
+EDGE_PORT = 8000
+STATUS_PATH = "/api/system/status"
+CHECK_READY = "portainer-ready"
+CHECK_ALIVE = "portainer-alive"
+CHECK_EDGE = "portainer-edge"
+CHECKS = (CHECK_READY, CHECK_ALIVE, CHECK_EDGE)
+# timing of the health checks when not configured, as pebble defaults them
+CHECK_PERIOD = "10s"
+CHECK_TIMEOUT = "3s"
+CHECK_THRESHOLD = 3
+CHECK_DOWN_MESSAGE = "portainer {} check is down"
+# portainer opens its ports only once its database migration finished, so the liveness checks,
+# which restart it, keep their own timing that tolerates 10 minutes of closed ports
+ALIVE_CHECK_TIMING = {"period": "30s", "timeout": "5s", "threshold": 20}
 SERVICE_VERSION = "portainer-ee"
 SERVICETYPE_LB = "LoadBalancer"
 SERVICETYPE_CIP = "ClusterIP"
@@ -28,300 +63,715 @@ CONFIG_SERVICEHTTPPORT = "service_http_port"
 CONFIG_SERVICEHTTPNODEPORT = "service_http_node_port"
 CONFIG_SERVICEEDGEPORT = "service_edge_port"
 CONFIG_SERVICEEDGENODEPORT = "service_edge_node_port"
+CONFIG_SERVICEEXTERNALTRAFFICPOLICY = "service_external_traffic_policy"
+CONFIG_SERVICEINTERNALTRAFFICPOLICY = "service_internal_traffic_policy"
+CONFIG_SERVICESESSIONAFFINITY = "service_session_affinity"
+CONFIG_SERVICESESSIONAFFINITYTIMEOUT = "service_session_affinity_timeout"
+CONFIG_SERVICEANNOTATIONS = "service_annotations"
+TRAFFICPOLICIES = ("Cluster", "Local")
+SESSIONAFFINITY_CLIENTIP = "ClientIP"
+SESSIONAFFINITIES = ("None", SESSIONAFFINITY_CLIENTIP)
+# longest client IP session affinity kubernetes accepts, one day
+SESSIONAFFINITY_MAX_TIMEOUT = 86400
+CONFIG_INGRESSHOSTNAME = "ingress_hostname"
+CONFIG_INGRESSTLSSECRET = "ingress_tls_secret_name"
+CONFIG_PROFILEHOOKS = "profile_hooks"
+CONFIG_BBOLTPATH = "bbolt_path"
+CONFIG_CHECKPERIOD = "health_check_period"
+CONFIG_CHECKTIMEOUT = "health_check_timeout"
+CONFIG_CHECKTHRESHOLD = "health_check_threshold"
+CONFIG_COMPACTINTERVAL = "compact_interval"
+CONFIG_CPUREQUEST = "workload_cpu_request"
+CONFIG_CPULIMIT = "workload_cpu_limit"
+CONFIG_MEMORYREQUEST = "workload_memory_request"
+CONFIG_MEMORYLIMIT = "workload_memory_limit"
+CONFIG_GOMAXPROCS = "go_max_procs"
+CONFIG_GOMEMLIMIT = "go_mem_limit"
+CONFIG_GOGC = "go_gc"
+CONFIG_SNAPSHOTINTERVAL = "snapshot_interval"
+CONFIG_LOGLEVEL = "log_level"
+LOGLEVELS = ("DEBUG", "INFO", "WARN", "ERROR")
+# a Go duration, as taken by Portainer and Pebble
+DURATION_PATTERN = re.compile(r"(\d+(\.\d+)?(ms|s|m|h))+")
+# share of the memory limit left to the Go heap when go_mem_limit isn't set
+GOMEMLIMIT_RATIO = 0.9
+SERVICEACCOUNT_NAME = "portainer-sa-clusteradmin"
+CLUSTERRB_NAME = "portainer"
+CLUSTERROLE_NAME = "cluster-admin"
+# seconds a successful k8s permission check is trusted for
+K8S_AUTH_TTL = 3600
+# (verb, api group, resource, namespaced) the charm needs on kubernetes
+K8S_PERMISSIONS = (
+    ("get", "", "services", True),
+    ("create", "", "services", True),
+    ("patch", "", "services", True),
+    ("get", "", "serviceaccounts", True),
+    ("create", "", "serviceaccounts", True),
+    ("patch", "", "serviceaccounts", True),
+    ("get", "rbac.authorization.k8s.io", "clusterroles", False),
+    ("get", "rbac.authorization.k8s.io", "clusterrolebindings", False),
+    ("create", "rbac.authorization.k8s.io", "clusterrolebindings", False),
+    ("patch", "rbac.authorization.k8s.io", "clusterrolebindings", False),
+    ("get", "apps", "statefulsets", True),
+    ("patch", "apps", "statefulsets", True),
+)
+# k8s requests sent concurrently, matching the connections kept alive by the client
+K8S_CONCURRENCY = k8s.POOL_MAXSIZE
+# most k8s requests a single dispatch may send
+K8S_REQUEST_BUDGET = 50
+# seconds between retries of a failed k8s reconcile, doubling up to the max
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 600
+TRUST_MESSAGE = "Run juju trust on this application to continue"
+RESTORE_MESSAGE = "portainer data is incomplete after a failed restore, run restore again"
+# owner of the fields the charm sets through server-side apply
+FIELD_MANAGER = "portainer-charm"
 
 class PortainerCharm(CharmBase):
     """Charm the service."""
+    # schema 1 of the state, only read to migrate units upgraded from it
     _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        # timings and call counts of this dispatch, logged when the framework commits
+        self._recorder = instrumentation.Recorder()
+        self._profile_dir = os.environ.get(instrumentation.PROFILE_DIR_ENV)
+        if not self._profile_dir and self.config.get(CONFIG_PROFILEHOOKS):
+            self._profile_dir = instrumentation.DEFAULT_PROFILE_DIR
+        if self._profile_dir:
+            self._recorder.start_profile()
+        # created on first use, so hooks that never talk to k8s don't pay for it
+        self._k8s_client = None
+        # worker threads may be the first to ask for the client, only one may create it
+        self._k8s_lock = threading.Lock()
+        # (dispatch context id, converged) of the last reconcile, None until it has run
+        self._reconciled = None
+        # portainer health check states by name, as last read during this dispatch
+        self._checks = None
         logger.info(f"initialising charm, version: {CHARM_VERSION}", )
-        # setup default config value, only create if not exist
-        self._stored.set_default(
+        # the state of the charm, with the default of every field
+        self._state = state.State(self, "state", dict(
             charm_version = CHARM_VERSION,
             config = self._default_config,
-        )
+            k8s_auth_expiry = 0,
+            k8s_resources = {},
+            k8s_converged = "",
+            retry_fingerprint = "",
+            retry_attempts = 0,
+            retry_not_before = 0,
+            compacted_at = 0,
+            restore_incomplete = False,
+        ))
         logger.debug(f"start with config: {self._config}")
-        # hooks up events
-        self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
-        self.framework.observe(self.on.start, self._start_portainer)
+        # hooks up events, every one of them converges the whole charm through a single reconcile
+        self.framework.observe(self.on.install, self._reconcile)
+        self.framework.observe(self.on.config_changed, self._reconcile)
+        self.framework.observe(self.on.start, self._reconcile)
+        self.framework.observe(self.on.leader_elected, self._reconcile)
         self.framework.observe(self.on.upgrade_charm, self._upgrade_charm)
-        self.framework.observe(self.on.portainer_pebble_ready, self._start_portainer)
+        self.framework.observe(self.on.portainer_pebble_ready, self._reconcile)
+        self.framework.observe(self.on.backup_action, self._on_backup_action)
+        self.framework.observe(self.on.restore_action, self._on_restore_action)
+        self.framework.observe(self.on.compact_database_action, self._on_compact_database_action)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        # the status follows the health checks, which the reconcile reads back
+        self.framework.observe(self.on.portainer_pebble_check_failed, self._reconcile)
+        self.framework.observe(self.on.portainer_pebble_check_recovered, self._reconcile)
+        self.framework.observe(self.on[INGRESS_RELATION].relation_joined, self._reconcile)
+        # the scrape job is published to prometheus by the leader, the address by every unit
+        self.framework.observe(self.on[METRICS_RELATION].relation_joined, self._on_metrics_endpoint)
+        self.framework.observe(self.on.leader_elected, self._on_metrics_endpoint)
+        self.framework.observe(self.on[METRICS_RELATION].relation_broken, self._on_metrics_endpoint_broken)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
 
-    def _on_install(self, event):
-        """Handle the install event, create Kubernetes resources"""
-        logger.info("installing charm")
-        if not self.unit.is_leader():
-            logger.warn("portainer must work as a leader, waiting for leadership")
-            self.unit.status = WaitingStatus('waiting for leadership')
+    def _on_commit(self, _):
+        """Reports the cost of this dispatch once every handler ran"""
+        self._recorder.log()
+        if self._profile_dir:
+            self._recorder.dump_profile(self._profile_dir)
+        try:
+            metrics.update(METRICS_DIR, self._recorder.summary(), self._checks)
+            if self.model.relations[METRICS_RELATION]:
+                metrics.ensure_exporter(METRICS_DIR)
+        except OSError as e:
+            # metrics are best effort, they must never fail the hook
+            logger.warning(f"couldn't update charm metrics: {e}")
+
+    @instrumentation.handler
+    def _on_metrics_endpoint(self, _):
+        """Publishes the scrape job of the metrics exporter on every metrics-endpoint relation"""
+        for relation in self.model.relations[METRICS_RELATION]:
+            # the charm and portainer share the pod network, so the unit address reaches both
+            address = self.model.get_binding(relation).network.bind_address
+            relation.data[self.unit].update({
+                "prometheus_scrape_unit_address": str(address) if address else "",
+                "prometheus_scrape_unit_name": self.unit.name,
+            })
+            if not self.unit.is_leader():
+                continue
+            relation.data[self.app].update({
+                "scrape_jobs": json.dumps([{
+                    "job_name": self.app.name,
+                    "metrics_path": "/metrics",
+                    "static_configs": [{"targets": [f"*:{metrics.EXPORTER_PORT}"]}],
+                }]),
+                "scrape_metadata": json.dumps({
+                    "model": self.model.name,
+                    "model_uuid": self.model.uuid,
+                    "application": self.app.name,
+                    "unit": self.unit.name,
+                    "charm_name": self.meta.name,
+                }),
+            })
+
+    @instrumentation.handler
+    def _on_metrics_endpoint_broken(self, event):
+        """Stops the metrics exporter once the last metrics-endpoint relation is gone"""
+        if not [r for r in self.model.relations[METRICS_RELATION] if r.id != event.relation.id]:
+            metrics.stop_exporter(METRICS_DIR)
+
+    @instrumentation.handler
+    def _reconcile(self, event):
+        """Handles every event by converging the charm to the desired state.
+
+        Deferred events are re-emitted in the same dispatch as the new one, so the work
+        is only done once per dispatch; later events reuse its outcome.
+        """
+        dispatch = os.environ.get("JUJU_CONTEXT_ID")
+        if self._reconciled is None or dispatch is None or self._reconciled[0] != dispatch:
+            started = time.monotonic()
+            self._reconciled = (dispatch, self._converge())
+            logger.info(
+                f"reconciled on {event.handle.kind} in {time.monotonic() - started:.3f}s, "
+                f"converged: {self._reconciled[1]}, "
+                f"k8s requests: {self._recorder.count('k8s')}")
+        if not self._reconciled[1]:
+            self._recorder.record("charm", "defer", 0)
             event.defer()
+
+    def _converge(self) -> bool:
+        """Brings k8s resources, the pebble layer and the unit status in line with the config.
+
+        Returns False when the work has to be retried later; states that are resolved by an
+        upcoming event (config-changed, leader-elected, pebble-ready) don't need a retry.
+        """
+        # self.model.config is the aggregated config in the current runtime
+        logger.debug(f"current config: {self._config} vs future config: {self.model.config}")
+        if not self._validate_config(self.model.config):
+            self.unit.status = WaitingStatus('waiting for a valid config')
+            logger.info("waiting for a valid config")
+            return True
+        if self.model.config.get(CONFIG_COMPACTINTERVAL) and not self._config.get(CONFIG_COMPACTINTERVAL):
+            # the first scheduled compaction runs one interval after it is enabled
+            self._state.compacted_at = time.time()
+        # merge the runtime config with stored one
+        self._config = { **self._config, **self.model.config }
+        logger.debug(f"merged config: {self._config}")
+        converged = True
+        status = None
+        if not self.unit.is_leader():
+            logger.warning("portainer must work as a leader, waiting for leadership")
+            status = WaitingStatus('waiting for leadership')
+        else:
+            status = self._reconcile_k8s(self._config)
+            converged = status is None
+            self._update_ingress(self._config)
+        # the layer is diffed against the running plan, so this is a no-op unless the command changed
+        if not self._update_pebble(self._config):
+            logger.info("waiting for container to start")
+            status = status or WaitingStatus('waiting for container to start')
+        if self._state.restore_incomplete:
+            status = BlockedStatus(RESTORE_MESSAGE)
+        self.unit.status = status or self._workload_status() or ActiveStatus()
+        return converged
+
+    def _refresh_workload_status(self):
+        """Replaces an active or health check status with the current state of the health checks"""
+        status = self.unit.status
+        if not isinstance(status, ActiveStatus) and status.message not in {CHECK_DOWN_MESSAGE.format(name) for name in CHECKS}:
             return
+        container = self.unit.get_container(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "can_connect"):
+            if not container.can_connect():
+                return
+        self.unit.status = self._workload_status() or ActiveStatus()
+
+    def _workload_status(self):
+        """Returns the status reflecting failing portainer health checks, None when all pass"""
+        container = self.unit.get_container(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "get_checks"):
+            checks = container.get_checks(*CHECKS)
+        self._checks = {
+            name: check.status == pebble.CheckStatus.UP and not check.failures
+            for name, check in checks.items()
+        }
+        for name in CHECKS:
+            check = checks.get(name)
+            if check is None:
+                continue
+            # failures below the threshold are transient, only a down check changes the status
+            if check.status == pebble.CheckStatus.DOWN:
+                return WaitingStatus(CHECK_DOWN_MESSAGE.format(name))
+        return None
+
+    def _reconcile_k8s(self, config: dict):
+        """Applies the k8s resources Portainer needs, skipped when they are already converged.
+
+        Returns None once converged, otherwise the status to show until the next attempt. Only
+        transient API errors delay it, by an exponential backoff persisted across dispatches;
+        missing trust is checked again at the next hook, such as the one `juju trust` triggers.
+        """
+        fingerprint = utils.fingerprint(self._k8s_resources_by_config(config))
+        if self._state.k8s_converged == fingerprint:
+            logger.info("k8s resources are converged, skip applying")
+            return None
+        # a failed attempt at the same desired state is only retried once its backoff elapsed
+        wait = self._state.retry_not_before - time.time()
+        if self._state.retry_fingerprint == fingerprint and wait > 0:
+            logger.info(f"backing off k8s reconcile for another {wait:.0f}s")
+            if isinstance(self.unit.status, BlockedStatus):
+                # the countdown must not hide what the operator has to act on
+                return self.unit.status
+            return WaitingStatus(f"retrying kubernetes setup in {wait:.0f}s")
+        retry_after = None
+        try:
+            status = self._apply_k8s_by_config(config)
+        except k8s.ApiError as e:
+            if e.status == 403:
+                # permissions were revoked since they were last checked
+                self._state.k8s_auth_expiry = 0
+                status = BlockedStatus(TRUST_MESSAGE)
+            elif e.transient:
+                status = WaitingStatus(f"kubernetes api unavailable: {e.reason}")
+                retry_after = e.retry_after
+            else:
+                raise e
+            logger.warning(f"k8s reconcile failed: {e}")
+        if retry_after is not None:
+            self._schedule_k8s_retry(fingerprint, retry_after)
+            return status
+        if status is None:
+            self._state.k8s_converged = fingerprint
+        self._state.retry_fingerprint = ""
+        self._state.retry_attempts = 0
+        return status
+
+    def _apply_k8s_by_config(self, config: dict):
+        """Applies the k8s resources by config, returns None when done or the status to show"""
         if not self._k8s_auth():
-            self.unit.status = WaitingStatus('waiting for k8s auth')
-            logger.info("waiting for k8s auth, installation deferred")
-            event.defer()
+            logger.info("waiting for k8s auth")
+            return BlockedStatus(TRUST_MESSAGE)
+        self.unit.status = MaintenanceStatus("applying kubernetes resources for portainer")
+        # the resources don't depend on each other, a binding to a missing role is just inert
+        tasks = {"clusterrole": self._check_k8s_cluster_role}
+        for key, (path, manifest) in self._k8s_resources_by_config(config).items():
+            tasks[key] = functools.partial(
+                self._apply_k8s_resource, key, path, manifest, self._state.k8s_resources.get(key))
+        results = self._run_k8s_tasks(tasks)
+        for key in self._k8s_resources_by_config(config):
+            self._state.k8s_resources[key] = results[key][0]
+        if not results["clusterrole"]:
+            logger.info("waiting for service account preconditions")
+            return WaitingStatus('waiting for service account preconditions')
+        return None
+
+    def _schedule_k8s_retry(self, fingerprint: str, retry_after: int = 0):
+        """Persists when a failed k8s reconcile of fingerprint may be attempted again"""
+        attempts = self._state.retry_attempts if self._state.retry_fingerprint == fingerprint else 0
+        delay = max(retry_after, utils.backoff_delay(attempts, RETRY_BASE_DELAY, RETRY_MAX_DELAY))
+        self._state.retry_fingerprint = fingerprint
+        self._state.retry_attempts = attempts + 1
+        self._state.retry_not_before = time.time() + delay
+        logger.info(f"k8s reconcile attempt {attempts + 1} failed, retrying in {delay:.0f}s")
+
+    def _update_ingress(self, config: dict):
+        """Publishes Portainer Web to the ingress relation, if any, when it changed"""
+        relation = self.model.get_relation(INGRESS_RELATION)
+        if relation is None:
             return
-        self.unit.status = MaintenanceStatus("creating kubernetes service for portainer")
-        self._create_k8s_service_by_config()
-        if not self._create_k8s_service_account():
-            self.unit.status = WaitingStatus('waiting for service account perconditions')
-            logger.info("waiting for service account perconditions, installation deferred")
-            event.defer()
+        data = relation.data[self.app]
+        ingress = self._build_ingress_by_config(config)
+        if dict(data) == ingress:
             return
+        logger.info(f"publishing ingress: {ingress}")
+        for key in set(data) - set(ingress):
+            del data[key]
+        data.update(ingress)
 
-    def _update_pebble(self, event, config: dict):
-        """Update pebble by config"""
+    def _update_pebble(self, config: dict) -> bool:
+        """Update pebble by config, returns False if the container is not reachable yet"""
         logger.info("updating pebble")
         # get a reference to the portainer workload container
         container = self.unit.get_container(CONTAINER_NAME)
-        if container.can_connect():
-            svc = container.get_services().get(CONTAINER_NAME, None)
-            # check if the pebble service is already running
-            if svc:
-                logger.info("stopping pebble service")
-                container.stop(CONTAINER_NAME)
-            # override existing layer
-            container.add_layer(CONTAINER_NAME, self._build_layer_by_config(config), combine = True)
-            logger.info("starting pebble service")
-            container.start(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "can_connect"):
+            if not container.can_connect():
+                return False
+        layer = self._build_layer_by_config(config)
+        with self._recorder.timed("pebble", "get_plan"):
+            plan = container.get_plan()
+        desired = pebble.Layer(layer)
+        current = {
+            **{name: plan.services[name] for name in desired.services if name in plan.services},
+            **{name: plan.checks[name] for name in desired.checks if name in plan.checks},
+        }
+        wanted = {**desired.services, **desired.checks}
+        if {n: c.to_dict() for n, c in current.items()} == {n: w.to_dict() for n, w in wanted.items()}:
+            with self._recorder.timed("pebble", "get_services"):
+                svc = container.get_services(CONTAINER_NAME).get(CONTAINER_NAME)
+            # nothing changed and it is already running, leave the workload alone
+            if svc and svc.is_running():
+                logger.info("pebble plan is up to date, skip updating")
+                return True
         else:
-            self.unit.status = WaitingStatus('waiting for container to start')
-            logger.info("waiting for container to start, update pebble deferred")
-            event.defer()
+            # override existing layer
+            with self._recorder.timed("pebble", "add_layer"):
+                container.add_layer(CONTAINER_NAME, layer, combine = True)
+        # replan only restarts the service when its definition changed
+        logger.info("replanning pebble service")
+        with self._recorder.timed("pebble", "replan"):
+            container.replan()
+        return True
 
-    def _on_config_changed(self, event):
-        """Handles the configuration changes"""
-        logger.info("configuring charm")
-        # self.model.config is the aggregated config in the current runtime
-        logger.debug(f"current config: {self._config} vs future config: {self.model.config}")
-        if not self._validate_config(self.model.config):
-            self.unit.status = WaitingStatus('waiting for a valid config')
-            logger.info("waiting for a valid config, configuration deferred")
-            event.defer()
+    @instrumentation.handler
+    def _on_backup_action(self, event):
+        """Archives the portainer data directory"""
+        container = self.unit.get_container(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "can_connect"):
+            connected = container.can_connect()
+        if not connected:
+            event.fail("portainer container is not ready")
             return
-        # merge the runtime config with stored one
-        new_config = { **self._config, **self.model.config }
-        if new_config != self._config:
-            if not self._k8s_auth():
-                self.unit.status = WaitingStatus('waiting for k8s auth')
-                logger.info("waiting for k8s auth, configuration deferred")
-                event.defer()
-                return
-            self._patch_k8s_service_by_config(new_config)
-        # update pebble if service type is changed to or from nodeport
-        if (new_config[CONFIG_SERVICETYPE] != self._config[CONFIG_SERVICETYPE]
-            and (new_config[CONFIG_SERVICETYPE] == SERVICETYPE_NP 
-                or self._config[CONFIG_SERVICETYPE] == SERVICETYPE_NP)):
-            self._update_pebble(event, new_config)
-        # set the config
-        self._config = new_config
-        logger.debug(f"merged config: {self._config}")
+        destination = event.params.get("path") or os.path.join(
+            BACKUP_DIR, f"portainer-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz")
+        logger.info(f"backing up {DATA_DIR} to {destination}")
+        try:
+            results = backup.backup(
+                container, DATA_DIR, destination, functools.partial(self._quiesced, container),
+                timed = functools.partial(self._recorder.timed, "pebble"),
+            )
+        except (backup.BackupError, pebble.Error, OSError) as e:
+            logger.error(f"backup failed: {e}")
+            event.fail(f"backup failed: {e}")
+            return
+        logger.info(f"backup done: {results}")
+        event.set_results(results)
+
+    @instrumentation.handler
+    def _on_restore_action(self, event):
+        """Restores the portainer data directory from an archive"""
+        container = self.unit.get_container(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "can_connect"):
+            connected = container.can_connect()
+        if not connected:
+            event.fail("portainer container is not ready")
+            return
+        source = event.params["path"]
+        logger.info(f"restoring {DATA_DIR} from {source}")
+        try:
+            results = backup.restore(
+                container, DATA_DIR, source, functools.partial(self._restoring, container),
+                sha256 = event.params.get("sha256"),
+                timed = functools.partial(self._recorder.timed, "pebble"),
+            )
+        except (backup.BackupError, pebble.Error, OSError) as e:
+            logger.error(f"restore failed: {e}")
+            if self._state.restore_incomplete:
+                self.unit.status = BlockedStatus(RESTORE_MESSAGE)
+            event.fail(f"restore failed: {e}")
+            return
+        logger.info(f"restore done: {results}")
+        # starts portainer again if a failed restore left it stopped
+        self._update_pebble(self._config)
+        if self.unit.status == BlockedStatus(RESTORE_MESSAGE):
+            self.unit.status = self._workload_status() or ActiveStatus()
+        event.set_results(results)
 
-    def _start_portainer(self, _):
-        """Function to handle starting Portainer using Pebble"""
-        # Get a reference to the portainer workload container
+    @instrumentation.handler
+    def _on_compact_database_action(self, event):
+        """Compacts the portainer database"""
+        try:
+            results = self._compact_database()
+        except (database.CompactionError, pebble.Error) as e:
+            logger.error(f"database compaction failed: {e}")
+            event.fail(f"database compaction failed: {e}")
+            return
+        if results is None:
+            event.fail("portainer database is not available")
+            return
+        event.set_results(results)
+
+    @instrumentation.handler
+    def _on_update_status(self, _):
+        """Refreshes the health check status, repairs k8s resources drifted out of band and runs
+        the scheduled database compaction"""
+        self._refresh_workload_status()
+        self._check_k8s_drift()
+        interval = self._config.get(CONFIG_COMPACTINTERVAL) or 0
+        if not interval:
+            return
+        if not self._state.compacted_at:
+            # enabled before its time was recorded, start counting the interval from now
+            self._state.compacted_at = time.time()
+            return
+        if time.time() < self._state.compacted_at + interval * 3600:
+            return
+        logger.info("running scheduled database compaction")
+        try:
+            self._compact_database()
+        except (database.CompactionError, pebble.Error) as e:
+            # retried at the next interval instead of every update-status
+            logger.error(f"scheduled database compaction failed: {e}")
+            self._state.compacted_at = time.time()
+
+    def _compact_database(self):
+        """Compacts the portainer database, returns its results or None if there is none yet"""
         container = self.unit.get_container(CONTAINER_NAME)
-        if container.can_connect():
-            svc = container.get_services().get(CONTAINER_NAME, None)
-            # Check if the service is already running
-            if not svc:
-                # Add a new layer
-                container.add_layer(CONTAINER_NAME, self._build_layer_by_config(self._config), combine = True)
-                container.start(CONTAINER_NAME)
+        with self._recorder.timed("pebble", "can_connect"):
+            connected = container.can_connect()
+        if not connected:
+            return None
+        with self._recorder.timed("pebble", "exists"):
+            if not container.exists(DATABASE_PATH):
+                return None
+        previous = self.unit.status
+        self.unit.status = MaintenanceStatus("compacting portainer database")
+        try:
+            results = database.compact(
+                container, DATABASE_PATH, self._config.get(CONFIG_BBOLTPATH) or "bbolt",
+                functools.partial(self._quiesced, container),
+                timed = functools.partial(self._recorder.timed, "pebble"),
+            )
+        finally:
+            self.unit.status = previous
+        logger.info(f"database compaction done: {results}")
+        self._state.compacted_at = time.time()
+        return results
+
+    @contextlib.contextmanager
+    def _quiesced(self, container, restart_on_error: bool = True):
+        """Stops portainer for the enclosed block, starting it again afterwards if it was running,
+        unless the block raised and restart_on_error is False"""
+        with self._recorder.timed("pebble", "get_services"):
+            svc = container.get_services(CONTAINER_NAME).get(CONTAINER_NAME)
+        running = svc is not None and svc.is_running()
+        if running:
+            logger.info("stopping pebble service")
+            with self._recorder.timed("pebble", "stop"):
+                container.stop(CONTAINER_NAME)
+        try:
+            yield
+        except BaseException:
+            if not restart_on_error and running:
+                logger.error("leaving pebble service stopped")
+                running = False
+            raise
+        finally:
+            if running:
+                logger.info("starting pebble service")
+                with self._recorder.timed("pebble", "start"):
+                    container.start(CONTAINER_NAME)
+
+    @contextlib.contextmanager
+    def _restoring(self, container):
+        """Stops portainer while its data directory is replaced.
 
-            self.unit.status = ActiveStatus()
+        If that fails part way portainer stays stopped, and isn't started by later hooks, until a
+        restore succeeds: on partial data it would come up as a new, uninitialised instance whose
+        admin account anyone reaching it first could create.
+        """
+        with self._quiesced(container, restart_on_error = False):
+            self._state.restore_incomplete = True
+            yield
+            self._state.restore_incomplete = False
 
-    def _upgrade_charm(self, _):
+    @instrumentation.handler
+    def _upgrade_charm(self, event):
         """Handle charm upgrade"""
-        logger.info(f"upgrading from {self._stored.charm_version} to {CHARM_VERSION}")
-        if CHARM_VERSION < self._stored.charm_version:
+        if self._state.version is None:
+            self._migrate_state()
+        logger.info(f"upgrading from {self._state.charm_version} to {CHARM_VERSION}")
+        if CHARM_VERSION < self._state.charm_version:
             logger.error("downgrade is not supported")
-        elif CHARM_VERSION == self._stored.charm_version:
+        elif CHARM_VERSION == self._state.charm_version:
             logger.info("nothing to upgrade")
         else:
             # upgrade logic here
-            logger.info("nothing to upgrade")
+            self._state.charm_version = CHARM_VERSION
+        self._reconcile(event)
+
+    def _migrate_state(self):
+        """Moves the fields of a unit upgraded from state schema 1 into the current one"""
+        legacy = {}
+        # the only fields released charms stored
+        for name in ("charm_version", "config"):
+            value = getattr(self._stored, name, None)
+            if value is not None:
+                legacy[name] = value
+        if not legacy:
+            return
+        logger.info(f"migrating state fields to schema {state.SCHEMA_VERSION}: {', '.join(sorted(legacy))}")
+        self._state.update(legacy)
+        # the old snapshot is never read again, drop it instead of keeping it in juju
+        self.framework.drop_snapshot(Handle(self, "StoredStateData", "_stored"))
 
     def _k8s_auth(self) -> bool:
         """Authenticate to kubernetes."""
+        # a positive answer is trusted until it expires, so repeated hooks skip the round-trips
+        if self._state.k8s_auth_expiry > time.time():
+            logger.debug("k8s auth cached, skip checking permissions")
+            return True
         # Authenticate against the Kubernetes API using a mounted ServiceAccount token
-        kubernetes.config.load_incluster_config()
-        # Test the service account we've got for sufficient perms
-        api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient())
-
+        client = self._k8s
+        # Ask the API server whether the service account may do what the charm needs,
+        # which costs the same regardless of how many resources live in the namespace;
+        # the reviews are independent, so they are sent concurrently
+        tasks = {
+            f"{verb} {resource}": functools.partial(
+                client.access_allowed, verb, resource, group = group,
+                namespace = self.namespace if namespaced else None)
+            for verb, group, resource, namespaced in K8S_PERMISSIONS
+        }
         try:
-            api.list_namespaced_service(namespace = self.namespace)
-        except kubernetes.client.exceptions.ApiException as e:
+            allowed = self._run_k8s_tasks(tasks)
+        except k8s.ApiError as e:
             if e.status == 403:
-                # If we can't read a cluster role, we don't have enough permissions
-                self.unit.status = BlockedStatus("Run juju trust on this application to continue")
                 return False
             else:
                 raise e
+        missing = [name for name, result in allowed.items() if not result]
+        if missing:
+            # If we can't manage our resources, we don't have enough permissions
+            logger.info(f"missing k8s permissions: {', '.join(missing)}")
+            return False
+        self._state.k8s_auth_expiry = time.time() + K8S_AUTH_TTL
         return True
 
-    def _replace_k8s_service_by_config(self, new_config: dict):
-        """Replace k8s service by stored config."""
-        logger.info("replacing k8s service by config")
-        logger.debug(f"replacing by config: {new_config}")
-        api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient())
-        # a direct replacement of /spec won't work, since it misses things like cluster_ip;
-        # need to get the existing config, replace the key parts inside then submit.
-        existing = None
-        try:
-            existing = api.read_namespaced_service(
-                name = self.app.name,
-                namespace = self.namespace,
-            )
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:
-                logger.info("portainer service doesn't exist, skip patching")
-                return
-            else:
-                raise e
-        if not existing:
-            logger.info("portainer service doesn't exist, skip patching")
+    def _check_k8s_drift(self):
+        """Re-applies the k8s resources owned by the charm that were changed or deleted out of band.
+
+        Only runs once the resources are converged; an object still at the resourceVersion last
+        seen costs a single metadata read, the others are read in full and only re-applied when
+        they no longer match their manifest.
+        """
+        if not self.unit.is_leader() or not self._state.k8s_converged:
             return
-        replace = self._build_k8s_spec_by_config(new_config)
-        existing.spec.type = replace.spec.type
-        existing.spec.ports = replace.spec.ports
-        api.replace_namespaced_service(
-            name = self.app.name, 
-            namespace = self.namespace, 
-            body = existing,
-        )
-
-    # Issue with this method:
-    # _build_k8s_spec_by_config generates the object that leaves 'None'
-    # when stringified, e.g. {'cluster_ip': None,'external_i_ps': None,'external_name': None},
-    # causing k8s complaining: Invalid value: []core.IPFamily(nil): primary ipFamily can not be unset
-    def _patch_k8s_service_by_config(self, new_config: dict):
-        """Patch k8s service by stored config."""
-        logger.info("updating k8s service by config")
-        client = kubernetes.client.ApiClient()
-        api = kubernetes.client.CoreV1Api(client)
-        
-        # a direct replacement of /spec won't work, since it misses things like cluster_ip;
-        # need to serialize the object to dictionay then clean none entries to replace bits by bits.
-        spec = utils.clean_nones(
-            client.sanitize_for_serialization(
-                self._build_k8s_spec_by_config(new_config)))
-        body = []
-        for k, v in spec.items():
-            body.append({
-                "op": "replace",
-                "path": f"/spec/{k}",
-                "value": v,
-            })
-        logger.debug(f"patching with body: {body}")
-        if body:
-            api.patch_namespaced_service(
-                name = self.app.name,
-                namespace = self.namespace,
-                body = body,
-            )
-        else:
-            logger.info("nothing to patch, skip patching")
+        resources = self._k8s_resources_by_config(self._config)
+        if utils.fingerprint(resources) != self._state.k8s_converged:
+            logger.info("k8s resources are being reconciled, skip checking drift")
             return
-    
-    def _create_k8s_service_by_config(self):
-        """Delete then create k8s service by stored config."""
-        logger.info("creating k8s service")
-        api = kubernetes.client.CoreV1Api(kubernetes.client.ApiClient())
+        tasks = {
+            key: functools.partial(self._check_k8s_resource, key, path, manifest, self._state.k8s_resources.get(key))
+            for key, (path, manifest) in resources.items()
+        }
         try:
-            api.delete_namespaced_service(name = self.app.name, namespace = self.namespace)
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:
-                logger.info("portainer service doesn't exist, skip deletion")
-            else:
-                raise e
-        api.create_namespaced_service(
-            namespace = self.namespace,
-            body = self._build_k8s_service_by_config(self._config),
-        )
-
-    def _create_k8s_service_account(self) -> bool:
-        """Delete then create the service accounts needed by Portainer"""
-        logger.info("creating k8s service account")
-        SERVICEACCOUNT_NAME = "portainer-sa-clusteradmin"
-        CLUSTERRB_NAME = "portainer"
-        CLUSTERROLE_NAME = "cluster-admin"
-        client = kubernetes.client.ApiClient()
-        api = kubernetes.client.CoreV1Api(client)
-        rbac = kubernetes.client.RbacAuthorizationV1Api(client)
-        # check cluster role, make sure it exists
+            results = self._run_k8s_tasks(tasks)
+        except k8s.ApiError as e:
+            if e.status == 403:
+                self._state.k8s_auth_expiry = 0
+            # checked again at the next update-status
+            logger.warning(f"k8s drift check failed: {e}")
+            return
+        for key, (record, _) in results.items():
+            self._state.k8s_resources[key] = record
+        drifted = [key for key, (_, written) in results.items() if written]
+        if drifted:
+            logger.warning(f"re-applied k8s resources changed out of band: {', '.join(drifted)}")
+
+    def _check_k8s_resource(self, key: str, path: str, manifest: dict, applied: dict = None) -> tuple:
+        """Returns the record of a k8s resource and whether it had to be re-applied to undo a drift"""
+        if applied:
+            try:
+                metadata = self._k8s.get_metadata(path)["metadata"]
+            except k8s.ApiError as e:
+                if e.status != 404:
+                    raise e
+                logger.warning(f"k8s {key} was deleted")
+                return self._apply_k8s_resource(key, path, manifest)
+            if metadata["resourceVersion"] == applied["resource_version"]:
+                return applied, False
+        return self._apply_k8s_resource(key, path, manifest, applied)
+
+    def _check_k8s_cluster_role(self) -> bool:
+        """Returns whether the cluster role bound to Portainer's service account exists"""
         try:
-            rbac.read_cluster_role(name = CLUSTERROLE_NAME)
-        except kubernetes.client.exceptions.ApiException as e:
+            self._k8s.get(f"{k8s.CLUSTERROLES_PATH}/{CLUSTERROLE_NAME}")
+        except k8s.ApiError as e:
             if e.status == 404:
                 logger.error(f"{CLUSTERROLE_NAME} cluster role doesn't exist, please make sure RBAC is enabled in k8s cluster.")
                 return False
             else:
                 raise e
-        # creates service account
-        try:
-            api.delete_namespaced_service_account(
-              name = SERVICEACCOUNT_NAME, 
-              namespace = self.namespace
-            )
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:
-                logger.info(f"{SERVICEACCOUNT_NAME} service account doesn't exist, skip deletion")
-            else:
-                raise e
-        api.create_namespaced_service_account(
-            namespace = self.namespace,
-            body = kubernetes.client.V1ServiceAccount(
-                api_version = "v1",
-                metadata = kubernetes.client.V1ObjectMeta(
-                    namespace = self.namespace,
-                    name = SERVICEACCOUNT_NAME,
-                    labels = {
-                        "app.kubernetes.io/name": self.app.name,
-                        "app.kubernetes.io/instance": self.app.name,
-                        "app.kubernetes.io/version": SERVICE_VERSION,
-                    },
-                ),
-            ),
-        )
-        # create cluster role binding with the service account
-        logger.info("creating k8s cluster role binding")
-        try:
-            rbac.delete_cluster_role_binding(name = CLUSTERRB_NAME)
-        except kubernetes.client.exceptions.ApiException as e:
-            if e.status == 404:
-                logger.info(f"{CLUSTERRB_NAME} cluster role binding doesn't exist, skip deletion")
-            else:
-                raise e
-        rbac.create_cluster_role_binding(
-            body = kubernetes.client.V1ClusterRoleBinding(
-                api_version = "rbac.authorization.k8s.io/v1",
-                metadata = kubernetes.client.V1ObjectMeta(
-                    namespace = self.namespace,
-                    name = self.app.name,
-                    labels = {
-                        "app.kubernetes.io/name": self.app.name,
-                        "app.kubernetes.io/instance": self.app.name,
-                        "app.kubernetes.io/version": SERVICE_VERSION,
-                    },
-                ),
-                role_ref = kubernetes.client.V1RoleRef(
-                    api_group = "rbac.authorization.k8s.io",
-                    kind = "ClusterRole",
-                    name = CLUSTERROLE_NAME,
-                ),
-                subjects = [
-                    kubernetes.client.V1Subject(
-                        kind = "ServiceAccount",
-                        namespace = self.namespace,
-                        name = SERVICEACCOUNT_NAME,
-                    ),
-                ],
-            )
-        )
         return True
 
+    def _apply_k8s_resource(self, key: str, path: str, manifest: dict, applied: dict = None) -> tuple:
+        """Server-side apply a k8s resource unless the live object already matches the manifest.
+
+        applied is the record of the last apply, holding the fingerprint of its manifest and the
+        resourceVersion it produced. Returns the new record and whether the resource was written;
+        it doesn't touch the stored state, so resources can be applied from worker threads.
+        """
+        fingerprint = utils.fingerprint(manifest)
+        if applied and applied["fingerprint"] == fingerprint:
+            live = None
+            try:
+                live = self._k8s.get(path)
+            except k8s.ApiError as e:
+                if e.status != 404:
+                    raise e
+            if live and (live["metadata"]["resourceVersion"] == applied["resource_version"]
+                or utils.is_subset(manifest, live)):
+                logger.info(f"k8s {key} is up to date, skip applying")
+                return {
+                    "fingerprint": fingerprint,
+                    "resource_version": live["metadata"]["resourceVersion"],
+                }, False
+        logger.debug(f"applying k8s {key}: {manifest}")
+        result = self._k8s.apply(path, manifest, field_manager = FIELD_MANAGER)
+        return {
+            "fingerprint": fingerprint,
+            "resource_version": result["metadata"]["resourceVersion"],
+        }, True
+
+    def _run_k8s_tasks(self, tasks: dict) -> dict:
+        """Runs independent k8s tasks concurrently and returns their results by name.
+
+        Every task is allowed to finish; failures are then reported together as the most
+        severe one, a fatal error over a permission error over a transient one.
+        """
+        started = time.monotonic()
+        durations = {}
+
+        def timed(name, task):
+            task_started = time.monotonic()
+            try:
+                return task()
+            finally:
+                durations[name] = time.monotonic() - task_started
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = K8S_CONCURRENCY) as executor:
+            futures = {name: executor.submit(timed, name, task) for name, task in tasks.items()}
+        results = {}
+        failures = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except k8s.ApiError as e:
+                logger.warning(f"k8s {name} failed: {e}")
+                failures[name] = e
+        logger.info(
+            f"k8s tasks done in {time.monotonic() - started:.3f}s: "
+            + ", ".join(f"{name} {duration:.3f}s" for name, duration in durations.items()))
+        if failures:
+            error = min(failures.values(), key = lambda e: (e.transient, e.status == 403))
+            raise k8s.ApiError(
+                error.status,
+                f"{', '.join(failures)}: {error.reason}",
+                error.body,
+                retry_after = max(e.retry_after for e in failures.values()),
+            )
+        return results
+
     def _validate_config(self, config: dict) -> bool:
         """Validates the input config"""
         if config.get(CONFIG_SERVICETYPE) not in (SERVICETYPE_CIP, SERVICETYPE_LB, SERVICETYPE_NP):
@@ -337,84 +787,328 @@ class PortainerCharm(CharmBase):
             and config.get(CONFIG_SERVICEHTTPNODEPORT) is not None):
             logger.error(f"config - service http and edge node port cannot be the same")
             return False
+        if not self._validate_traffic_config(config):
+            return False
+        if (config.get(CONFIG_COMPACTINTERVAL) or 0) < 0:
+            logger.error(f"config - {CONFIG_COMPACTINTERVAL} cannot be negative")
+            return False
+        for key in (CONFIG_SNAPSHOTINTERVAL, CONFIG_CHECKPERIOD, CONFIG_CHECKTIMEOUT):
+            if config.get(key) and not DURATION_PATTERN.fullmatch(config[key]):
+                logger.error(f"config - {key} {config[key]} is not a valid duration")
+                return False
+        if config.get(CONFIG_CHECKTHRESHOLD) is not None and config[CONFIG_CHECKTHRESHOLD] < 1:
+            logger.error(f"config - {CONFIG_CHECKTHRESHOLD} must be at least 1")
+            return False
+        # pebble rejects checks that never run, or can't finish before the next one starts
+        period = utils.parse_duration(config.get(CONFIG_CHECKPERIOD) or CHECK_PERIOD)
+        timeout = utils.parse_duration(config.get(CONFIG_CHECKTIMEOUT) or CHECK_TIMEOUT)
+        if not 0 < timeout < period:
+            logger.error(f"config - {CONFIG_CHECKTIMEOUT} must be above zero and shorter than {CONFIG_CHECKPERIOD}")
+            return False
+        if config.get(CONFIG_LOGLEVEL) and config[CONFIG_LOGLEVEL] not in LOGLEVELS:
+            logger.error(f"config - {CONFIG_LOGLEVEL} {config[CONFIG_LOGLEVEL]} is not one of {', '.join(LOGLEVELS)}")
+            return False
+        return self._validate_workload_config(config)
+
+    def _validate_traffic_config(self, config: dict) -> bool:
+        """Validates the traffic policies, session affinity and annotations of the input config"""
+        for key in (CONFIG_SERVICEEXTERNALTRAFFICPOLICY, CONFIG_SERVICEINTERNALTRAFFICPOLICY):
+            if config.get(key) and config[key] not in TRAFFICPOLICIES:
+                logger.error(f"config - {key} {config[key]} is not one of {', '.join(TRAFFICPOLICIES)}")
+                return False
+        if config.get(CONFIG_SERVICESESSIONAFFINITY) and config[CONFIG_SERVICESESSIONAFFINITY] not in SESSIONAFFINITIES:
+            logger.error(f"config - {CONFIG_SERVICESESSIONAFFINITY} {config[CONFIG_SERVICESESSIONAFFINITY]} "
+                f"is not one of {', '.join(SESSIONAFFINITIES)}")
+            return False
+        if not 0 <= (config.get(CONFIG_SERVICESESSIONAFFINITYTIMEOUT) or 0) <= SESSIONAFFINITY_MAX_TIMEOUT:
+            logger.error(f"config - {CONFIG_SERVICESESSIONAFFINITYTIMEOUT} must be between 0 and {SESSIONAFFINITY_MAX_TIMEOUT}")
+            return False
+        try:
+            annotations = utils.parse_key_values(config.get(CONFIG_SERVICEANNOTATIONS) or "")
+        except ValueError as e:
+            logger.error(f"config - {CONFIG_SERVICEANNOTATIONS}: {e}")
+            return False
+        for key in annotations:
+            if not utils.is_qualified_name(key):
+                logger.error(f"config - {CONFIG_SERVICEANNOTATIONS}: {key} is not a valid annotation key")
+                return False
         return True
 
-    def _build_k8s_service_by_config(self, config: dict) -> kubernetes.client.V1Service:
-        """Constructs k8s service spec by input config"""
-        return kubernetes.client.V1Service(
-            api_version = "v1",
-            metadata = kubernetes.client.V1ObjectMeta(
-                namespace = self.namespace,
-                name = self.app.name,
-                labels = {
+    def _validate_workload_config(self, config: dict) -> bool:
+        """Validates the workload resources and Go runtime settings of the input config"""
+        quantities = {}
+        for key in (CONFIG_CPUREQUEST, CONFIG_CPULIMIT, CONFIG_MEMORYREQUEST, CONFIG_MEMORYLIMIT):
+            if config.get(key):
+                try:
+                    quantities[key] = utils.parse_quantity(config[key])
+                except ValueError:
+                    logger.error(f"config - {key} {config[key]} is not a valid kubernetes quantity")
+                    return False
+        for request, limit in ((CONFIG_CPUREQUEST, CONFIG_CPULIMIT), (CONFIG_MEMORYREQUEST, CONFIG_MEMORYLIMIT)):
+            if request in quantities and limit in quantities and quantities[request] > quantities[limit]:
+                logger.error(f"config - {request} cannot be greater than {limit}")
+                return False
+        if (config.get(CONFIG_GOMAXPROCS) or 0) < 0:
+            logger.error(f"config - {CONFIG_GOMAXPROCS} cannot be negative")
+            return False
+        if config.get(CONFIG_GOMEMLIMIT) and not re.fullmatch(r"\d+(B|KiB|MiB|GiB|TiB)?", config[CONFIG_GOMEMLIMIT]):
+            logger.error(f"config - {CONFIG_GOMEMLIMIT} {config[CONFIG_GOMEMLIMIT]} is not a valid Go memory limit")
+            return False
+        if config.get(CONFIG_GOGC) and not re.fullmatch(r"\d+|off", config[CONFIG_GOGC]):
+            logger.error(f"config - {CONFIG_GOGC} {config[CONFIG_GOGC]} must be a percentage or off")
+            return False
+        return True
+
+    def _k8s_resources_by_config(self, config: dict) -> dict:
+        """Returns the (API path, manifest) of every k8s resource owned by the charm, by key"""
+        resources = {
+            "service": (
+                self._k8s_service_path,
+                self._build_k8s_service_by_config(config),
+            ),
+            "serviceaccount": (
+                f"{k8s.SERVICEACCOUNTS_PATH.format(namespace = self.namespace)}/{SERVICEACCOUNT_NAME}",
+                self._build_k8s_service_account(),
+            ),
+            "clusterrolebinding": (
+                f"{k8s.CLUSTERROLEBINDINGS_PATH}/{CLUSTERRB_NAME}",
+                self._build_k8s_cluster_role_binding(),
+            ),
+        }
+        statefulset = self._build_k8s_statefulset_by_config(config)
+        # the workload's resources are only managed once set, and kept managed so clearing them applies
+        if statefulset["spec"]["template"]["spec"]["containers"][0]["resources"] or "statefulset" in self._state.k8s_resources:
+            resources["statefulset"] = (
+                f"{k8s.STATEFULSETS_PATH.format(namespace = self.namespace)}/{self.app.name}",
+                statefulset,
+            )
+        return resources
+
+    def _build_k8s_service_by_config(self, config: dict) -> dict:
+        """Constructs k8s service manifest by input config"""
+        return utils.clean_nones({
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {
+                "namespace": self.namespace,
+                "name": self.app.name,
+                "labels": {
                     "io.portainer.kubernetes.application.stack": self.app.name,
-                    "app.kubernetes.io/name": self.app.name,
-                    "app.kubernetes.io/instance": self.app.name,
-                    "app.kubernetes.io/version": SERVICE_VERSION,
+                    **self._k8s_labels,
                 },
-            ),
-            spec = self._build_k8s_spec_by_config(config),
-        )
+                "annotations": utils.parse_key_values(config.get(CONFIG_SERVICEANNOTATIONS) or "") or None,
+            },
+            "spec": self._build_k8s_spec_by_config(config),
+        })
 
-    def _build_k8s_spec_by_config(self, config: dict) -> kubernetes.client.V1ServiceSpec:
+    def _build_k8s_spec_by_config(self, config: dict) -> dict:
         """Constructs k8s service spec by input config"""
         service_type = config[CONFIG_SERVICETYPE]
-        http_port = kubernetes.client.V1ServicePort(
-            name = "http",
-            port = config[CONFIG_SERVICEHTTPPORT],
-            target_port = 9000,
-        )
-        if (service_type == SERVICETYPE_NP 
-            and CONFIG_SERVICEHTTPNODEPORT in config):
-            http_port.node_port = config[CONFIG_SERVICEHTTPNODEPORT]
-
-        edge_port = kubernetes.client.V1ServicePort(
-            name = "edge",
-            port = config[CONFIG_SERVICEEDGEPORT],
-            target_port = 8000,
-        )
-        if (service_type == SERVICETYPE_NP 
-            and CONFIG_SERVICEEDGENODEPORT in config):
-            edge_port.node_port = config[CONFIG_SERVICEEDGENODEPORT]
-        
-        result = kubernetes.client.V1ServiceSpec(
-            type = service_type,
-            ports = [
-                http_port,
-                edge_port,
+        is_node_port = service_type == SERVICETYPE_NP
+        result = utils.clean_nones({
+            "type": service_type,
+            "ports": [
+                {
+                    "name": "http",
+                    "port": config[CONFIG_SERVICEHTTPPORT],
+                    "targetPort": HTTP_PORT,
+                    "nodePort": config.get(CONFIG_SERVICEHTTPNODEPORT) if is_node_port else None,
+                },
+                {
+                    "name": "edge",
+                    "port": config[CONFIG_SERVICEEDGEPORT],
+                    "targetPort": EDGE_PORT,
+                    "nodePort": config.get(CONFIG_SERVICEEDGENODEPORT) if is_node_port else None,
+                },
             ],
-            selector = {
+            "selector": {
                 "app.kubernetes.io/name": self.app.name,
             },
-        )
+            # only services reachable from outside the cluster have an external traffic policy
+            "externalTrafficPolicy": (config.get(CONFIG_SERVICEEXTERNALTRAFFICPOLICY) or None
+                if service_type != SERVICETYPE_CIP else None),
+            "internalTrafficPolicy": config.get(CONFIG_SERVICEINTERNALTRAFFICPOLICY) or None,
+            "sessionAffinity": config.get(CONFIG_SERVICESESSIONAFFINITY) or None,
+            "sessionAffinityConfig": {
+                "clientIP": {
+                    "timeoutSeconds": config[CONFIG_SERVICESESSIONAFFINITYTIMEOUT],
+                },
+            } if (config.get(CONFIG_SERVICESESSIONAFFINITY) == SESSIONAFFINITY_CLIENTIP
+                and config.get(CONFIG_SERVICESESSIONAFFINITYTIMEOUT)) else None,
+        })
         logger.debug(f"generating spec: {result}")
         return result
 
+    def _build_k8s_statefulset_by_config(self, config: dict) -> dict:
+        """Constructs the partial workload statefulset manifest carrying the portainer container resources"""
+        resources = {}
+        for section, cpu, memory in (
+            ("requests", CONFIG_CPUREQUEST, CONFIG_MEMORYREQUEST),
+            ("limits", CONFIG_CPULIMIT, CONFIG_MEMORYLIMIT),
+        ):
+            values = utils.clean_nones({
+                "cpu": config.get(cpu) or None,
+                "memory": config.get(memory) or None,
+            })
+            if values:
+                resources[section] = values
+        return {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {
+                "namespace": self.namespace,
+                "name": self.app.name,
+            },
+            "spec": {
+                "template": {
+                    "spec": {
+                        "containers": [
+                            {
+                                "name": CONTAINER_NAME,
+                                "resources": resources,
+                            },
+                        ],
+                    },
+                },
+            },
+        }
+
+    def _build_ingress_by_config(self, config: dict) -> dict:
+        """Constructs the ingress relation data routing to the HTTP port of the portainer service.
+
+        The controller terminates TLS and serves HTTP/2 when given a secret; the Edge tunnel
+        port is left out, agents keep reaching it over plain TCP through the service.
+        """
+        return utils.clean_nones({
+            "service-hostname": config.get(CONFIG_INGRESSHOSTNAME) or self.app.name,
+            "service-name": self.app.name,
+            "service-namespace": self.namespace,
+            "service-port": str(config[CONFIG_SERVICEHTTPPORT]),
+            "tls-secret-name": config.get(CONFIG_INGRESSTLSSECRET) or None,
+        })
+
+    def _build_k8s_service_account(self) -> dict:
+        """Constructs the k8s service account manifest used by Portainer"""
+        return {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {
+                "namespace": self.namespace,
+                "name": SERVICEACCOUNT_NAME,
+                "labels": self._k8s_labels,
+            },
+        }
+
+    def _build_k8s_cluster_role_binding(self) -> dict:
+        """Constructs the k8s cluster role binding manifest for Portainer's service account"""
+        return {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "ClusterRoleBinding",
+            "metadata": {
+                "name": CLUSTERRB_NAME,
+                "labels": self._k8s_labels,
+            },
+            "roleRef": {
+                "apiGroup": "rbac.authorization.k8s.io",
+                "kind": "ClusterRole",
+                "name": CLUSTERROLE_NAME,
+            },
+            "subjects": [
+                {
+                    "kind": "ServiceAccount",
+                    "namespace": self.namespace,
+                    "name": SERVICEACCOUNT_NAME,
+                },
+            ],
+        }
+
     def _build_layer_by_config(self, config: dict) -> dict:
         """Returns a pebble layer by config"""
         cmd = "/portainer"
+        edge_port = EDGE_PORT
         if (config[CONFIG_SERVICETYPE] == SERVICETYPE_NP 
             and CONFIG_SERVICEEDGENODEPORT in config):
             cmd = f"{cmd} --tunnel-port {config[CONFIG_SERVICEEDGENODEPORT]}"
+            edge_port = config[CONFIG_SERVICEEDGENODEPORT]
+        if config.get(CONFIG_SNAPSHOTINTERVAL):
+            cmd = f"{cmd} --snapshot-interval {config[CONFIG_SNAPSHOTINTERVAL]}"
+        if config.get(CONFIG_LOGLEVEL):
+            cmd = f"{cmd} --log-level {config[CONFIG_LOGLEVEL]}"
+        service = {
+            "override": "replace",
+            "command": cmd,
+            # held stopped after a failed restore, see _restoring
+            "startup": "disabled" if self._state.restore_incomplete else "enabled",
+            # a process that keeps its ports closed for longer than any migration takes is restarted
+            "on-check-failure": {
+                CHECK_ALIVE: "restart",
+                CHECK_EDGE: "restart",
+            },
+        }
+        environment = self._build_go_environment_by_config(config)
+        if environment:
+            service["environment"] = environment
+        timing = {
+            "period": config.get(CONFIG_CHECKPERIOD) or CHECK_PERIOD,
+            "timeout": config.get(CONFIG_CHECKTIMEOUT) or CHECK_TIMEOUT,
+            "threshold": CHECK_THRESHOLD if config.get(CONFIG_CHECKTHRESHOLD) is None else config[CONFIG_CHECKTHRESHOLD],
+        }
         return {
             "services": {
-                CONTAINER_NAME: {
+                CONTAINER_NAME: service,
+            },
+            "checks": {
+                CHECK_READY: {
                     "override": "replace",
-                    "command": cmd,
-                    "startup": "enabled",
-                }
+                    "level": "ready",
+                    "http": {"url": f"http://localhost:{HTTP_PORT}{STATUS_PATH}"},
+                    **timing,
+                },
+                CHECK_ALIVE: {
+                    "override": "replace",
+                    "level": "alive",
+                    "tcp": {"port": HTTP_PORT},
+                    **ALIVE_CHECK_TIMING,
+                },
+                CHECK_EDGE: {
+                    "override": "replace",
+                    "level": "alive",
+                    "tcp": {"port": edge_port},
+                    **ALIVE_CHECK_TIMING,
+                },
             },
         }
 
+    def _build_go_environment_by_config(self, config: dict) -> dict:
+        """Returns the Go runtime environment of portainer by config,
+        sized from the workload limits unless set explicitly"""
+        environment = {}
+        max_procs = config.get(CONFIG_GOMAXPROCS) or 0
+        if not max_procs and config.get(CONFIG_CPULIMIT):
+            # the Go runtime sizes itself by the node's cores, not by the container's cpu quota
+            max_procs = max(1, math.ceil(utils.parse_quantity(config[CONFIG_CPULIMIT])))
+        if max_procs:
+            environment["GOMAXPROCS"] = str(max_procs)
+        mem_limit = config.get(CONFIG_GOMEMLIMIT)
+        if not mem_limit and config.get(CONFIG_MEMORYLIMIT):
+            # leave headroom for non-heap memory, so the GC kicks in before the OOM killer does
+            mem_limit = str(int(utils.parse_quantity(config[CONFIG_MEMORYLIMIT]) * GOMEMLIMIT_RATIO))
+        if mem_limit:
+            environment["GOMEMLIMIT"] = mem_limit
+        if config.get(CONFIG_GOGC):
+            environment["GOGC"] = config[CONFIG_GOGC]
+        return environment
+
     @property
     def _config(self) -> dict:
         """Returns the stored config"""
-        return self._stored.config
+        return self._state.config
 
     @_config.setter
     def _config(self, config: dict):
         """Sets the stored config to input"""
-        self._stored.config = config
+        if config != self._state.config:
+            self._state.config = config
 
     @property
     def _default_config(self) -> dict:
@@ -430,11 +1124,35 @@ class PortainerCharm(CharmBase):
           CONFIG_SERVICEEDGEPORT: 8000,
       }
 
+    @property
+    def _k8s(self) -> k8s.Client:
+        """Returns the k8s client shared by every request of this hook dispatch"""
+        with self._k8s_lock:
+            if self._k8s_client is None:
+                self._k8s_client = k8s.Client(
+                    budget = K8S_REQUEST_BUDGET,
+                    observer = functools.partial(self._recorder.record, "k8s"),
+                )
+        return self._k8s_client
+
+    @property
+    def _k8s_labels(self) -> dict:
+        """Returns the common labels of k8s resources owned by this charm"""
+        return {
+            "app.kubernetes.io/name": self.app.name,
+            "app.kubernetes.io/instance": self.app.name,
+            "app.kubernetes.io/version": SERVICE_VERSION,
+        }
+
+    @property
+    def _k8s_service_path(self) -> str:
+        """Returns the API path of the portainer k8s service"""
+        return f"{k8s.SERVICES_PATH.format(namespace = self.namespace)}/{self.app.name}"
+
     @property
     def namespace(self) -> str:
         """Fetch the current Kubernetes namespace by reading it from the service account"""
-        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
-            return f.read().strip()
+        return k8s.read_namespace()
 
 
 if __name__ == "__main__":
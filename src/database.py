@@ -0,0 +1,78 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Offline maintenance of the Portainer BoltDB store.
+
+The compaction runs inside the workload container with the bbolt command
+line tool, through Pebble exec, and the verified result is renamed over the
+original there too, so the store never travels through the charm. Each Pebble
+call is made within timed(name), a context manager the caller may pass to
+record how long it took.
+"""
+
+import contextlib
+import logging
+import time
+
+from ops import pebble
+
+logger = logging.getLogger(__name__)
+
+# seconds a single bbolt command may run
+EXEC_TIMEOUT = 1800
+# renames the compacted store over the original, rename(2) replaces it atomically
+MOVE_COMMAND = "mv"
+
+
+class CompactionError(Exception):
+    """Raised when the database couldn't be compacted, the original is left in place"""
+
+
+def _size(container, path: str, timed) -> int:
+    """Returns the size of a file in the container"""
+    with timed("list_files"):
+        return container.list_files(path, itself = True)[0].size
+
+
+def _exec(container, command: list, timed):
+    """Runs a command in the container, raises CompactionError if it fails"""
+    logger.info(f"running {' '.join(command)}")
+    try:
+        with timed("exec"):
+            container.exec(command, timeout = EXEC_TIMEOUT).wait_output()
+    except pebble.ExecError as e:
+        raise CompactionError(f"{command[0]} {command[1]} exited with {e.exit_code}: {(e.stderr or '').strip()}") from e
+    except (pebble.APIError, pebble.TimeoutError) as e:
+        raise CompactionError(f"{command[0]} {command[1]} couldn't run: {e}") from e
+
+
+def compact(container, path: str, bbolt: str, quiesce, timed = contextlib.nullcontext) -> dict:
+    """Compacts the BoltDB store at path in the container.
+
+    quiesce is a context manager stopping Portainer while the store is compacted into a
+    new file next to it, checked, and renamed over the original with mv, which the image
+    must ship next to bbolt; a failure at any point leaves the original untouched.
+    Returns the sizes and timings.
+    """
+    started = time.monotonic()
+    with timed("list_files"):
+        info = container.list_files(path, itself = True)[0]
+    target = f"{path}.compact"
+    with quiesce():
+        quiesced = time.monotonic()
+        try:
+            _exec(container, [bbolt, "compact", "-o", target, path], timed)
+            _exec(container, [bbolt, "check", target], timed)
+            _exec(container, [MOVE_COMMAND, "-f", target, path], timed)
+        finally:
+            with timed("exists"):
+                leftover = container.exists(target)
+            if leftover:
+                with timed("remove_path"):
+                    container.remove_path(target)
+        downtime = time.monotonic() - quiesced
+    return {
+        "size-before": info.size,
+        "size-after": _size(container, path, timed),
+        "downtime": round(downtime, 3),
+        "duration": round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,112 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Timings and call counts of a single hook dispatch.
+
+A Recorder collects how long each handler took and every k8s and Pebble call
+made while handling the dispatch, and renders them as one JSON log line.
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# setting it to a directory dumps a cProfile of every dispatch there
+PROFILE_DIR_ENV = "PORTAINER_CHARM_PROFILE_DIR"
+DEFAULT_PROFILE_DIR = "/tmp/portainer-charm-profiles"
+
+
+class Recorder:
+    """Collects the cost of one hook dispatch"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.handlers = {}
+        self.calls = {}
+        # k8s calls are made from worker threads too
+        self._lock = threading.Lock()
+        self._profile = None
+
+    def record(self, kind: str, name: str, seconds: float, status: int = None, sent: int = 0, received: int = 0):
+        """Records one call of kind (k8s, pebble) named name"""
+        with self._lock:
+            stats = self.calls.setdefault(kind, {}).setdefault(name, {
+                "count": 0, "seconds": 0.0, "bytes_sent": 0, "bytes_received": 0, "statuses": {},
+            })
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["bytes_sent"] += sent
+            stats["bytes_received"] += received
+            if status is not None:
+                stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+
+    def record_handler(self, name: str, seconds: float):
+        """Records one run of the handler named name"""
+        with self._lock:
+            stats = self.handlers.setdefault(name, {"count": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, kind: str, name: str):
+        """Records the wall time of the enclosed block as a call"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.monotonic() - started)
+
+    def count(self, kind: str) -> int:
+        """Returns the number of calls of kind recorded so far"""
+        with self._lock:
+            return sum(stats["count"] for stats in self.calls.get(kind, {}).values())
+
+    def summary(self) -> dict:
+        """Returns the recorded costs as a JSON serializable dictionary"""
+        with self._lock:
+            return {
+                "hook": os.environ.get("JUJU_HOOK_NAME") or os.environ.get("JUJU_DISPATCH_PATH", ""),
+                "seconds": round(time.monotonic() - self.started, 6),
+                "handlers": self.handlers,
+                "calls": self.calls,
+            }
+
+    def start_profile(self):
+        """Starts profiling the dispatch with cProfile"""
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def dump_profile(self, directory: str):
+        """Stops profiling and dumps the stats to a file named after the hook in directory"""
+        if self._profile is None:
+            return
+        self._profile.disable()
+        os.makedirs(directory, exist_ok = True)
+        hook = os.path.basename(self.summary()["hook"]) or "dispatch"
+        path = os.path.join(directory, f"{hook}-{time.time():.0f}.prof")
+        self._profile.dump_stats(path)
+        self._profile = None
+        logger.info(f"dispatch profile written to {path}")
+
+    def log(self):
+        """Logs the recorded costs as a single JSON line"""
+        logger.info(json.dumps({"dispatch_metrics": self.summary()}, sort_keys = True))
+
+
+def handler(method):
+    """Decorates a charm event handler to record its wall time in the charm's recorder"""
+    @functools.wraps(method)
+    def wrapper(charm, event, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return method(charm, event, *args, **kwargs)
+        finally:
+            charm._recorder.record_handler(
+                f"{method.__name__}:{event.handle.kind}", time.monotonic() - started)
+    return wrapper
@@ -0,0 +1,203 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Minimal Kubernetes API access for the charm.
+
+Only the handful of endpoints the charm touches are needed, so requests are
+issued as plain JSON over urllib3 instead of going through the generated
+`kubernetes` client and its model package. Importing this module only pulls in
+the standard library; urllib3 is imported the first time a request is made.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SERVICEACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+SERVICES_PATH = "/api/v1/namespaces/{namespace}/services"
+SERVICEACCOUNTS_PATH = "/api/v1/namespaces/{namespace}/serviceaccounts"
+STATEFULSETS_PATH = "/apis/apps/v1/namespaces/{namespace}/statefulsets"
+CLUSTERROLES_PATH = "/apis/rbac.authorization.k8s.io/v1/clusterroles"
+CLUSTERROLEBINDINGS_PATH = "/apis/rbac.authorization.k8s.io/v1/clusterrolebindings"
+SELFSUBJECTACCESSREVIEWS_PATH = "/apis/authorization.k8s.io/v1/selfsubjectaccessreviews"
+
+# connections kept alive to the API server by a client
+POOL_MAXSIZE = 4
+# seconds before giving up on the API server
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+CONTENT_JSON = "application/json"
+CONTENT_JSON_PATCH = "application/json-patch+json"
+CONTENT_APPLY_PATCH = "application/apply-patch+yaml"
+# asks for the metadata of an object only, leaving out its spec and status
+CONTENT_METADATA = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1"
+
+
+# statuses worth retrying later: conflicts, throttling and server side failures
+TRANSIENT_STATUSES = (409, 429, 500, 502, 503, 504)
+
+
+class ApiError(Exception):
+    """Raised when the Kubernetes API answers with a non-successful status,
+    or with no status at all when the API server couldn't be reached"""
+
+    def __init__(self, status: int, reason: str, body: dict = None, retry_after: int = 0):
+        super().__init__(f"kubernetes api error {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.body = body or {}
+        self.retry_after = retry_after
+
+    @property
+    def transient(self) -> bool:
+        """Returns whether the same request may succeed when retried later"""
+        return self.status is None or self.status in TRANSIENT_STATUSES
+
+
+class BudgetExhausted(ApiError):
+    """Raised when a client has sent all the requests it was allowed to"""
+
+    def __init__(self, budget: int):
+        super().__init__(None, f"request budget of {budget} exhausted")
+
+
+@functools.lru_cache(maxsize = None)
+def read_namespace() -> str:
+    """Returns the namespace of the mounted service account, read once per process"""
+    with open(os.path.join(SERVICEACCOUNT_DIR, "namespace"), "r") as f:
+        return f.read().strip()
+
+
+class Client:
+    """JSON client for the Kubernetes API, authenticated by the mounted ServiceAccount
+
+    A client owns a single urllib3 pool, so every request sent through it reuses
+    the same keep-alive connection and TLS session. Create one per hook dispatch
+    and share it instead of creating one per call.
+    """
+
+    def __init__(self, host: str = None, token: str = None, ca_file: str = None, budget: int = None,
+                 observer = None):
+        if host is None:
+            # same discovery rules as the in-cluster config of the official client
+            service_host = os.environ["KUBERNETES_SERVICE_HOST"]
+            if ":" in service_host:
+                service_host = f"[{service_host}]"
+            host = f"https://{service_host}:{os.environ['KUBERNETES_SERVICE_PORT']}"
+            with open(os.path.join(SERVICEACCOUNT_DIR, "token"), "r") as f:
+                token = f.read().strip()
+            ca_file = os.path.join(SERVICEACCOUNT_DIR, "ca.crt")
+        self.host = host.rstrip("/")
+        self.token = token
+        self.ca_file = ca_file
+        self._pool = None
+        # number of requests sent through this client, and how many it may send
+        self.requests = 0
+        self.budget = budget
+        # called with (name, seconds, status, bytes sent, bytes received) after every request
+        self.observer = observer
+        # clients are shared by worker threads; urllib3 pools are thread-safe, the counter isn't
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """Returns the urllib3 pool manager shared by every request of this client"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+        return self._pool
+
+    def _new_pool(self):
+        """Creates the urllib3 pool manager, importing urllib3 on first use"""
+        import urllib3
+        kwargs = {
+            "maxsize": POOL_MAXSIZE,
+            "block": True,
+            "timeout": urllib3.Timeout(connect = CONNECT_TIMEOUT, read = READ_TIMEOUT),
+        }
+        if self.ca_file:
+            kwargs.update(cert_reqs = "CERT_REQUIRED", ca_certs = self.ca_file)
+        return urllib3.PoolManager(**kwargs)
+
+    def request(self, method: str, path: str, body = None, content_type: str = CONTENT_JSON,
+                accept: str = CONTENT_JSON) -> dict:
+        """Sends a request to the API server and returns the decoded JSON response"""
+        headers = {"Accept": accept}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        data = None
+        if body is not None:
+            headers["Content-Type"] = content_type
+            data = json.dumps(body).encode("utf-8")
+        with self._lock:
+            if self.budget is not None and self.requests >= self.budget:
+                raise BudgetExhausted(self.budget)
+            self.requests += 1
+        logger.debug(f"kubernetes api request: {method} {path}")
+        pool = self.pool
+        started = time.monotonic()
+        try:
+            response = pool.request(method, f"{self.host}{path}", body = data, headers = headers)
+        except Exception as e:
+            self._observe(method, path, started, None, data, b"")
+            # urllib3 is imported lazily, so its errors can't be named at module level
+            import urllib3
+            if isinstance(e, urllib3.exceptions.HTTPError):
+                raise ApiError(None, str(e)) from e
+            raise
+        self._observe(method, path, started, response.status, data, response.data)
+        try:
+            payload = json.loads(response.data) if response.data else {}
+        except ValueError:
+            payload = {"message": response.data.decode("utf-8", "replace")}
+        if response.status >= 400:
+            retry_after = response.headers.get("Retry-After", "")
+            raise ApiError(
+                response.status, response.reason, payload,
+                retry_after = int(retry_after) if retry_after.isdigit() else 0,
+            )
+        return payload
+
+    def _observe(self, method: str, path: str, started: float, status: int, sent: bytes, received: bytes):
+        """Reports a finished request to the observer, if any"""
+        if self.observer:
+            self.observer(
+                f"{method} {path.split('?')[0]}", time.monotonic() - started,
+                status, len(sent or b""), len(received or b""),
+            )
+
+    def get(self, path: str) -> dict:
+        return self.request("GET", path)
+
+    def get_metadata(self, path: str) -> dict:
+        """Returns the object at path as PartialObjectMetadata, or in full from servers without it"""
+        return self.request("GET", path, accept = f"{CONTENT_METADATA},{CONTENT_JSON}")
+
+    def create(self, path: str, body: dict) -> dict:
+        return self.request("POST", path, body)
+
+    def patch(self, path: str, body, content_type: str = CONTENT_JSON_PATCH) -> dict:
+        return self.request("PATCH", path, body, content_type)
+
+    def apply(self, path: str, body: dict, field_manager: str) -> dict:
+        """Server-side applies body to the object at path, creating it when missing"""
+        # JSON is valid YAML, so the manifest can be sent as an apply patch as is
+        return self.patch(f"{path}?fieldManager={field_manager}&force=true", body, CONTENT_APPLY_PATCH)
+
+    def access_allowed(self, verb: str, resource: str, group: str = "", namespace: str = None) -> bool:
+        """Returns whether the authenticated account may perform verb on resource"""
+        attributes = {"verb": verb, "group": group, "resource": resource}
+        if namespace:
+            attributes["namespace"] = namespace
+        review = self.create(SELFSUBJECTACCESSREVIEWS_PATH, {
+            "apiVersion": "authorization.k8s.io/v1",
+            "kind": "SelfSubjectAccessReview",
+            "spec": {"resourceAttributes": attributes},
+        })
+        return review.get("status", {}).get("allowed", False)
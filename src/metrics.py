@@ -0,0 +1,161 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Prometheus metrics of the charm and its workload.
+
+Hook dispatches are short-lived, so each one folds its costs into counters kept
+on the charm container's disk and re-renders them in the Prometheus text
+format. A small HTTP server, started once in the background from this module,
+serves that file to the scrape job registered on the metrics-endpoint relation.
+"""
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+EXPORTER_PORT = 9467
+METRICS_FILE = "metrics"
+COUNTERS_FILE = "counters.json"
+PID_FILE = "exporter.pid"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _write_atomic(path: str, content: str):
+    """Writes content to path so readers never see a partial file"""
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile("w", dir = directory, delete = False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+
+
+def _label(value: str) -> str:
+    """Escapes a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def update(directory: str, summary: dict, checks: dict = None):
+    """Adds the costs of a dispatch, as summarized by instrumentation.Recorder, to the counters
+    in directory and renders them with the current health check states to the metrics file"""
+    os.makedirs(directory, exist_ok = True)
+    path = os.path.join(directory, COUNTERS_FILE)
+    try:
+        with open(path, "r") as f:
+            counters = json.load(f)
+    except (OSError, ValueError):
+        counters = {}
+    hook = os.path.basename(summary["hook"]) or "unknown"
+    hooks = counters.setdefault("hooks", {}).setdefault(hook, {"count": 0, "seconds": 0.0})
+    hooks["count"] += 1
+    hooks["seconds"] += summary["seconds"]
+    calls = summary["calls"]
+    k8s_requests = counters.setdefault("k8s_requests", {})
+    k8s_requests[hook] = k8s_requests.get(hook, 0) + sum(c["count"] for c in calls.get("k8s", {}).values())
+    pebble_calls = counters.setdefault("pebble_calls", {})
+    for name, stats in calls.get("pebble", {}).items():
+        pebble_calls[name] = pebble_calls.get(name, 0) + stats["count"]
+    deferrals = counters.setdefault("deferrals", {})
+    deferrals[hook] = deferrals.get(hook, 0) + calls.get("charm", {}).get("defer", {}).get("count", 0)
+    if checks is not None:
+        counters["checks"] = checks
+    _write_atomic(path, json.dumps(counters))
+    _write_atomic(os.path.join(directory, METRICS_FILE), render(counters))
+
+
+def render(counters: dict) -> str:
+    """Renders the counters in the Prometheus text format"""
+    lines = [
+        "# HELP portainer_charm_hook_duration_seconds Wall time of the charm's hook dispatches.",
+        "# TYPE portainer_charm_hook_duration_seconds summary",
+    ]
+    for hook, stats in sorted(counters.get("hooks", {}).items()):
+        lines.append(f'portainer_charm_hook_duration_seconds_sum{{hook="{_label(hook)}"}} {stats["seconds"]}')
+        lines.append(f'portainer_charm_hook_duration_seconds_count{{hook="{_label(hook)}"}} {stats["count"]}')
+    lines += [
+        "# HELP portainer_charm_k8s_requests_total Kubernetes API requests sent by the charm.",
+        "# TYPE portainer_charm_k8s_requests_total counter",
+    ]
+    for hook, count in sorted(counters.get("k8s_requests", {}).items()):
+        lines.append(f'portainer_charm_k8s_requests_total{{hook="{_label(hook)}"}} {count}')
+    lines += [
+        "# HELP portainer_charm_deferrals_total Events deferred by the charm.",
+        "# TYPE portainer_charm_deferrals_total counter",
+    ]
+    for hook, count in sorted(counters.get("deferrals", {}).items()):
+        lines.append(f'portainer_charm_deferrals_total{{hook="{_label(hook)}"}} {count}')
+    lines += [
+        "# HELP portainer_charm_pebble_calls_total Pebble calls made by the charm; replan and start restart Portainer.",
+        "# TYPE portainer_charm_pebble_calls_total counter",
+    ]
+    for call, count in sorted(counters.get("pebble_calls", {}).items()):
+        lines.append(f'portainer_charm_pebble_calls_total{{call="{_label(call)}"}} {count}')
+    lines += [
+        "# HELP portainer_check_up Whether a Portainer health check passed when last seen by the charm.",
+        "# TYPE portainer_check_up gauge",
+    ]
+    for check, up in sorted(counters.get("checks", {}).items()):
+        lines.append(f'portainer_check_up{{check="{_label(check)}"}} {int(up)}')
+    return "\n".join(lines) + "\n"
+
+
+def ensure_exporter(directory: str, port: int = EXPORTER_PORT):
+    """Starts the exporter serving directory in the background unless it already runs"""
+    pid_path = os.path.join(directory, PID_FILE)
+    try:
+        with open(pid_path, "r") as f:
+            os.kill(int(f.read().strip()), 0)
+        return
+    except (OSError, ValueError):
+        pass
+    os.makedirs(directory, exist_ok = True)
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), directory, str(port)],
+        stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL,
+        start_new_session = True,
+    )
+    _write_atomic(pid_path, str(process.pid))
+    logger.info(f"started metrics exporter on port {port}, pid {process.pid}")
+
+
+def stop_exporter(directory: str):
+    """Stops the exporter serving directory, if it runs"""
+    try:
+        with open(os.path.join(directory, PID_FILE), "r") as f:
+            os.kill(int(f.read().strip()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+
+def serve(directory: str, port: int):
+    """Serves the metrics file of directory at /metrics until killed"""
+    # only the exporter process needs the HTTP server, hook dispatches never import it
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            try:
+                with open(os.path.join(directory, METRICS_FILE), "rb") as f:
+                    body = f.read()
+            except OSError:
+                body = b""
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http.server.ThreadingHTTPServer(("", port), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], int(sys.argv[2]))
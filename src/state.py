@@ -0,0 +1,115 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+"""Persistent state of the charm, read and written once per hook dispatch.
+
+With Juju storage every StoredState is a state-get when first read and a
+state-set whenever it is marked dirty at commit. State keeps all of the
+charm's fields in a single compact JSON document, decodes it into plain
+values once, and writes it back at commit only if a field really changed.
+"""
+
+import collections.abc
+import json
+import logging
+
+from ops.framework import Object, StoredState
+
+logger = logging.getLogger(__name__)
+
+# version of the document layout; 1 was one StoredState field per value
+SCHEMA_VERSION = 2
+# fields always written, even when they hold their default
+REQUIRED_FIELDS = ("charm_version",)
+
+
+def _encode(values: dict) -> str:
+    return json.dumps(values, sort_keys = True, separators = (",", ":"))
+
+
+def plain(value):
+    """Returns value with StoredDict and StoredList, or any other mapping and list, as dict and list"""
+    if isinstance(value, collections.abc.Mapping):
+        return {key: plain(val) for key, val in value.items()}
+    if isinstance(value, collections.abc.Sequence) and not isinstance(value, str):
+        return [plain(val) for val in value]
+    return value
+
+
+class State(Object):
+    """Fields of the charm's state, as attributes holding plain values
+
+    Values are decoded on first access and compared with their loaded copy when the
+    framework commits, so nested updates are persisted like assignments are and a
+    dispatch that changes nothing doesn't write anything. Fields equal to their
+    default are left out of the stored document.
+    """
+
+    _stored = StoredState()
+
+    def __init__(self, parent: Object, key: str, defaults: dict):
+        object.__setattr__(self, "_defaults", defaults)
+        super().__init__(parent, key)
+        object.__setattr__(self, "_values", None)
+        object.__setattr__(self, "_loaded", None)
+        object.__setattr__(self, "_version", None)
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+
+    def _load(self) -> dict:
+        """Decodes the stored document once per dispatch"""
+        if self._values is None:
+            document = getattr(self._stored, "document", None)
+            values = json.loads(document) if document else {}
+            object.__setattr__(self, "_version", values.pop("v", None))
+            if self._version is not None and self._version > SCHEMA_VERSION:
+                logger.error(f"state schema {self._version} is newer than {SCHEMA_VERSION}, fields may be lost")
+            object.__setattr__(self, "_loaded", {
+                name: values.get(name, default) for name, default in self._defaults.items()
+            })
+            object.__setattr__(self, "_values", json.loads(_encode(self._loaded)))
+        return self._values
+
+    @property
+    def version(self):
+        """Returns the schema version of the stored document, None if none was stored yet"""
+        self._load()
+        return self._version
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or name not in self._defaults:
+            raise AttributeError(name)
+        return self._load()[name]
+
+    def __setattr__(self, name: str, value):
+        if name in self._defaults:
+            self._load()[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def update(self, values: dict):
+        """Sets the known fields of values, ignoring the others"""
+        for name, value in values.items():
+            if name in self._defaults:
+                self._load()[name] = plain(value)
+
+    def changed(self) -> list:
+        """Returns the names of the fields changed since they were loaded"""
+        if self._values is None:
+            return []
+        return sorted(
+            name for name, value in self._values.items()
+            if _encode(value) != _encode(self._loaded[name])
+        )
+
+    def _on_pre_commit(self, _):
+        """Writes the document back if a field changed or it was never stored"""
+        changed = self.changed()
+        if not changed and (self._values is None or self._version == SCHEMA_VERSION):
+            return
+        document = {"v": SCHEMA_VERSION}
+        for name, value in self._values.items():
+            if name in REQUIRED_FIELDS or _encode(value) != _encode(self._defaults[name]):
+                document[name] = value
+        self._stored.document = _encode(document)
+        logger.debug(f"state written, changed fields: {', '.join(changed) or 'none'}")
+        object.__setattr__(self, "_loaded", json.loads(_encode(self._values)))
+        object.__setattr__(self, "_version", SCHEMA_VERSION)
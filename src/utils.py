@@ -1,3 +1,23 @@
+import hashlib
+import json
+import random
+import re
+
+# multipliers of the kubernetes quantity suffixes
+QUANTITY_SUFFIXES = {
+    "m": 1e-3, "": 1, "k": 1e3, "M": 1e6, "G": 1e9, "T": 1e12,
+    "Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40,
+}
+QUANTITY_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(m|k|M|G|T|Ki|Mi|Gi|Ti)?")
+# seconds in each unit of a Go duration
+DURATION_UNITS = {"ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+# name part of a kubernetes qualified name, such as an annotation or label key
+QUALIFIED_NAME_PATTERN = re.compile(r"[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?")
+# optional prefix of a qualified name, a DNS subdomain
+DNS_SUBDOMAIN_PATTERN = re.compile(r"[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*")
+
+
 def clean_nones(value: dict) -> dict:
     """
     Recursively remove all None values from dictionaries and lists, and returns
@@ -12,4 +32,83 @@ def clean_nones(value: dict) -> dict:
             if val is not None
         }
     else:
-        return value
\ No newline at end of file
+        return value
+
+
+def fingerprint(value) -> str:
+    """Returns a stable content hash of a JSON serializable value"""
+    encoded = json.dumps(value, sort_keys = True, separators = (",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def is_subset(expected, actual) -> bool:
+    """
+    Returns whether every value in expected is present in actual, recursing into
+    dictionaries and lists; extra keys in actual, such as server defaults, are ignored.
+    """
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(
+            key in actual and is_subset(val, actual[key])
+            for key, val in expected.items()
+        )
+    elif isinstance(expected, list):
+        if not isinstance(actual, list):
+            return False
+        # lists of named items, such as containers or ports, are merged by name by the API server
+        if expected and all(isinstance(e, dict) and "name" in e for e in expected):
+            named = {a.get("name"): a for a in actual if isinstance(a, dict)}
+            return all(is_subset(e, named.get(e["name"])) for e in expected)
+        return (len(expected) == len(actual)
+            and all(is_subset(e, a) for e, a in zip(expected, actual)))
+    else:
+        return expected == actual
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Returns the seconds to wait before retry number attempt (from 0), doubling from
+    base up to cap; half of the delay is randomized so units don't retry in lockstep.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_quantity(value: str) -> float:
+    """
+    Returns the numeric value of a kubernetes quantity such as 500m, 2 or 512Mi,
+    raises ValueError if it isn't one.
+    """
+    match = QUANTITY_PATTERN.fullmatch(str(value))
+    if not match:
+        raise ValueError(f"invalid quantity: {value}")
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2) or ""]
+
+
+def parse_key_values(value: str) -> dict:
+    """
+    Parses comma separated key=value pairs, such as annotations, into a dictionary,
+    raises ValueError on a pair without a key.
+    """
+    result = {}
+    for pair in value.split(","):
+        if not pair.strip():
+            continue
+        key, sep, val = pair.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"invalid key=value pair: {pair.strip()}")
+        result[key.strip()] = val.strip()
+    return result
+
+
+def parse_duration(value: str) -> float:
+    """Returns the seconds of a Go duration such as 1m30s, the caller validates its syntax"""
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in DURATION_PART_PATTERN.findall(value))
+
+
+def is_qualified_name(value: str) -> bool:
+    """Returns whether value is a valid kubernetes qualified name, an optional DNS subdomain
+    prefix and a slash followed by a name of at most 63 characters"""
+    prefix, slash, name = value.rpartition("/")
+    if slash and (len(prefix) > 253 or not DNS_SUBDOMAIN_PATTERN.fullmatch(prefix)):
+        return False
+    return bool(QUALIFIED_NAME_PATTERN.fullmatch(name))
@@ -0,0 +1,17 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+def redirect_metrics():
+    """Points the charm metrics at a temporary directory until the calling test module is done,
+    as frameworks committed by the tests flush them to the host otherwise"""
+    directory = tempfile.mkdtemp()
+    unittest.addModuleCleanup(shutil.rmtree, directory)
+    patcher = patch("charm.METRICS_DIR", directory)
+    patcher.start()
+    unittest.addModuleCleanup(patcher.stop)
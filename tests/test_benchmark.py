@@ -0,0 +1,299 @@
+# Copyright 2021 Portainer
+# See LICENSE file for licensing details.
+#
+# Drives the charm through its lifecycle against an in-process stand-in for the
+# Kubernetes API, asserting the resulting objects, the API requests every hook
+# may send and how long hooks and the charm import may take. Set
+# PORTAINER_BENCHMARK_REPORT to a file to get the measurements as JSON.
+
+import copy
+import functools
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import charm
+import k8s
+from charm import PortainerCharm
+from ops.model import ActiveStatus
+from ops.testing import Harness
+
+from tests import redirect_metrics
+
+NAMESPACE = "portainer-model"
+# most k8s requests each step may send
+REQUEST_BUDGETS = {
+    # 12 permission checks, the cluster role and 3 applies
+    "install": 16,
+    "config-changed": 0,
+    # the cluster role, a read of the unchanged service account and binding, the service apply
+    "node-port": 4,
+    # the cluster role and a read of each up to date resource
+    "reapply": 4,
+    "upgrade-charm": 0,
+    # a metadata read of the service, service account and binding
+    "update-status": 3,
+    # the metadata reads, then a full read and apply of the drifted object
+    "drift": 5,
+}
+# seconds a single step may take in-process, generous enough for slow CI runners
+HOOK_LATENCY_BUDGET = 1.0
+# seconds importing the charm may take in a fresh interpreter
+IMPORT_TIME_BUDGET = 1.0
+REPORT_ENV = "PORTAINER_BENCHMARK_REPORT"
+
+
+def setUpModule():
+    redirect_metrics()
+
+
+class FakeKubernetes:
+    """Kubernetes API stand-in serving the endpoints the charm uses from memory
+
+    Server-side apply merges the manifest into the stored object, fills the server
+    defaults of services and only bumps resourceVersion when the object changed.
+    """
+
+    def __init__(self):
+        self.objects = {
+            f"{k8s.CLUSTERROLES_PATH}/cluster-admin": {
+                "kind": "ClusterRole",
+                "metadata": {"name": "cluster-admin", "resourceVersion": "1"},
+            },
+        }
+        self.requests = []
+        self.version = 1
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body leave in one segment, or delayed ACKs add 40ms to every request
+            wbufsize = 64 * 1024
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, payload = fake.handle(self.command, self.path, body, self.headers.get("Accept", ""))
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method: str, path: str, body, accept: str = "") -> tuple:
+        """Returns the status and payload answering a request"""
+        path = path.split("?")[0]
+        with self._lock:
+            self.requests.append((method, path))
+            if method == "POST" and path == k8s.SELFSUBJECTACCESSREVIEWS_PATH:
+                return 201, {**body, "status": {"allowed": True}}
+            if method == "GET":
+                if path not in self.objects:
+                    return 404, {"kind": "Status", "reason": "NotFound"}
+                if accept.startswith(k8s.CONTENT_METADATA):
+                    return 200, {"kind": "PartialObjectMetadata", "metadata": self.objects[path]["metadata"]}
+                return 200, self.objects[path]
+            if method == "PATCH":
+                return 200, self.apply(path, body)
+        return 405, {"kind": "Status", "reason": "MethodNotAllowed"}
+
+    def apply(self, path: str, manifest: dict) -> dict:
+        """Merges manifest into the object at path like a forced server-side apply"""
+        current = self.objects.get(path, {})
+        applied = self.merge(copy.deepcopy(current), manifest)
+        if applied["kind"] == "Service":
+            self.default_service(applied["spec"])
+        applied["metadata"]["resourceVersion"] = current.get("metadata", {}).get("resourceVersion")
+        if applied != current:
+            self.version += 1
+            applied["metadata"]["resourceVersion"] = str(self.version)
+            self.objects[path] = applied
+        return self.objects[path]
+
+    def edit(self, path: str, change):
+        """Changes the object at path out of band, as another client would"""
+        with self._lock:
+            change(self.objects[path])
+            self.version += 1
+            self.objects[path]["metadata"]["resourceVersion"] = str(self.version)
+
+    def merge(self, target, patch):
+        if isinstance(target, dict) and isinstance(patch, dict):
+            for key, value in patch.items():
+                target[key] = self.merge(target.get(key), value)
+            return target
+        return copy.deepcopy(patch)
+
+    def default_service(self, spec: dict):
+        spec.setdefault("clusterIP", "10.152.183.10")
+        spec.setdefault("sessionAffinity", "None")
+        for index, port in enumerate(spec["ports"]):
+            port.setdefault("protocol", "TCP")
+            if spec["type"] != "ClusterIP":
+                port.setdefault("nodePort", 30000 + index)
+            else:
+                port.pop("nodePort", None)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self.requests)
+
+
+class TestBenchmark(unittest.TestCase):
+    measurements = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        report = os.environ.get(REPORT_ENV)
+        if report:
+            with open(report, "w") as f:
+                json.dump(cls.measurements, f, indent=2, sort_keys=True)
+
+    def setUp(self):
+        patcher = patch("k8s.read_namespace", return_value=NAMESPACE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake = FakeKubernetes()
+        self.addCleanup(self.fake.close)
+        self.harness = Harness(PortainerCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        # the same client the charm creates in a pod, pointed at the fake
+        self.harness.charm._k8s_client = k8s.Client(
+            host=self.fake.url,
+            budget=charm.K8S_REQUEST_BUDGET,
+            observer=functools.partial(self.harness.charm._recorder.record, "k8s"),
+        )
+
+    def step(self, name: str, action):
+        """Runs action, asserting it stays within the request and latency budgets of name"""
+        before = self.fake.count()
+        started = time.monotonic()
+        action()
+        seconds = time.monotonic() - started
+        requests = self.fake.count() - before
+        self.measurements[f"{self._testMethodName}:{name}"] = {"seconds": round(seconds, 4), "requests": requests}
+        self.assertLessEqual(requests, REQUEST_BUDGETS[name], f"{name} sent {self.fake.requests[before:]}")
+        self.assertLess(seconds, HOOK_LATENCY_BUDGET, f"{name} took {seconds:.3f}s")
+
+    def service(self) -> dict:
+        return self.fake.objects[f"/api/v1/namespaces/{NAMESPACE}/services/portainer"]
+
+    def install(self):
+        def install():
+            self.harness.set_leader(True)
+            self.harness.charm.on.install.emit()
+            self.harness.container_pebble_ready("portainer")
+        self.step("install", install)
+
+    def test_install(self):
+        self.install()
+        service = self.service()
+        self.assertEqual(service["spec"]["type"], "LoadBalancer")
+        self.assertEqual([p["port"] for p in service["spec"]["ports"]], [9000, 8000])
+        binding = self.fake.objects[f"{k8s.CLUSTERROLEBINDINGS_PATH}/portainer"]
+        self.assertEqual(binding["subjects"][0]["namespace"], NAMESPACE)
+        self.assertIn(f"/api/v1/namespaces/{NAMESPACE}/serviceaccounts/portainer-sa-clusteradmin", self.fake.objects)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_config_change(self):
+        self.install()
+        version = self.service()["metadata"]["resourceVersion"]
+        self.step("config-changed", lambda: self.harness.update_config({"log_level": "DEBUG"}))
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertIn("--log-level DEBUG", plan["services"]["portainer"]["command"])
+        self.assertEqual(self.service()["metadata"]["resourceVersion"], version)
+
+    def test_node_port_switch(self):
+        self.install()
+        self.step("node-port", lambda: self.harness.update_config({
+            "service_type": "NodePort", "service_http_node_port": 30777, "service_edge_node_port": 30776,
+        }))
+        spec = self.service()["spec"]
+        self.assertEqual(spec["type"], "NodePort")
+        self.assertEqual([p["nodePort"] for p in spec["ports"]], [30777, 30776])
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_reapply_unchanged_resources(self):
+        self.install()
+        charm = self.harness.charm
+        self.step("reapply", lambda: self.assertIsNone(charm._apply_k8s_by_config(charm._config)))
+        self.assertEqual({method for method, _ in self.fake.requests[-4:]}, {"GET"})
+
+    def test_upgrade(self):
+        self.install()
+        self.harness.framework.commit()
+        self.step("upgrade-charm", self.harness.charm.on.upgrade_charm.emit)
+        self.assertEqual(self.harness.charm._state.charm_version, charm.CHARM_VERSION)
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_update_status_without_drift(self):
+        self.install()
+        version = self.service()["metadata"]["resourceVersion"]
+        self.step("update-status", self.harness.charm.on.update_status.emit)
+        self.assertTrue(all(method == "GET" for method, _ in self.fake.requests[-3:]))
+        self.assertEqual(self.service()["metadata"]["resourceVersion"], version)
+
+    def test_drifted_service_is_reapplied(self):
+        self.install()
+        path = f"/api/v1/namespaces/{NAMESPACE}/services/portainer"
+        self.fake.edit(path, lambda service: service["spec"].update(type="NodePort"))
+        self.step("drift", self.harness.charm.on.update_status.emit)
+        self.assertEqual(self.service()["spec"]["type"], "LoadBalancer")
+        self.assertEqual([r for r in self.fake.requests[-5:] if r[0] == "PATCH"], [("PATCH", path)])
+        # the repaired service is at the resourceVersion the charm remembers
+        self.step("update-status", self.harness.charm.on.update_status.emit)
+
+    def test_unrelated_change_is_not_reapplied(self):
+        self.install()
+        self.fake.edit(
+            f"/api/v1/namespaces/{NAMESPACE}/services/portainer",
+            lambda service: service["metadata"].setdefault("annotations", {}).update(owner="someone"))
+        self.step("drift", self.harness.charm.on.update_status.emit)
+        self.assertNotIn("PATCH", [method for method, _ in self.fake.requests[-4:]])
+        self.step("update-status", self.harness.charm.on.update_status.emit)
+
+    def test_deleted_service_account_is_recreated(self):
+        self.install()
+        path = f"/api/v1/namespaces/{NAMESPACE}/serviceaccounts/portainer-sa-clusteradmin"
+        del self.fake.objects[path]
+        self.step("drift", self.harness.charm.on.update_status.emit)
+        self.assertIn(path, self.fake.objects)
+
+    def test_import_time(self):
+        code = "import time; started = time.perf_counter(); import charm; print(time.perf_counter() - started)"
+        samples = []
+        for _ in range(3):
+            result = subprocess.run(
+                [sys.executable, "-c", code],
+                check=True,
+                capture_output=True,
+                text=True,
+                env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            )
+            samples.append(float(result.stdout))
+        seconds = statistics.median(samples)
+        self.measurements["import"] = {"seconds": round(seconds, 4)}
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
@@ -3,64 +3,686 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, mock_open, patch
 
+import charm
+import k8s
 from charm import PortainerCharm
-from ops.model import ActiveStatus
-from ops.testing import Harness
+from ops import pebble, testing
+from ops.model import ActiveStatus, BlockedStatus
+from ops.testing import ActionFailed, Harness
 
+from tests import redirect_metrics
+
+
+def setUpModule():
+    redirect_metrics()
+
+
+class CharmTestCase(unittest.TestCase):
+    """Starts the charm in a harness, talking to a mocked k8s client, before every test"""
+
+    # whether the unit leads and its k8s permissions are already checked when a test starts
+    leader = True
+    k8s_authorized = True
 
-class TestCharm(unittest.TestCase):
     def setUp(self):
+        patcher = patch("k8s.read_namespace", return_value="portainer-model")
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.harness = Harness(PortainerCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
+        self.client = Mock(**{
+            "get.return_value": {"metadata": {"resourceVersion": "1"}},
+            "apply.return_value": {"metadata": {"resourceVersion": "1"}},
+        })
+        self.harness.charm._k8s_client = self.client
+        if self.k8s_authorized:
+            self.harness.charm._state.k8s_auth_expiry = float("inf")
+        if self.leader:
+            self.harness.set_leader(True)
+
+
+class TestImport(unittest.TestCase):
+    def test_import_is_lightweight(self):
+        # every hook dispatch imports the charm; the HTTP stack must only be loaded on demand
+        code = "import sys, charm; print(sorted(m for m in ('kubernetes', 'urllib3') if m in sys.modules))"
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            capture_output=True,
+            text=True,
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        )
+        self.assertEqual(result.stdout.strip(), "[]")
+
+
+class TestK8sClient(unittest.TestCase):
+    def tearDown(self):
+        k8s.read_namespace.cache_clear()
+
+    def test_namespace_is_read_once(self):
+        opener = mock_open(read_data="portainer-model\n")
+        with patch("builtins.open", opener):
+            self.assertEqual(k8s.read_namespace(), "portainer-model")
+            self.assertEqual(k8s.read_namespace(), "portainer-model")
+        opener.assert_called_once()
+
+    def test_charm_shares_one_client(self):
+        harness = Harness(PortainerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        with patch("k8s.Client") as client:
+            self.assertIs(harness.charm._k8s, harness.charm._k8s)
+        client.assert_called_once()
+
+    def test_workers_share_one_client(self):
+        # with a cached permission check, worker threads are the first to ask for the client
+        with patch("k8s.read_namespace", return_value="portainer-model"):
+            harness = Harness(PortainerCharm)
+            self.addCleanup(harness.cleanup)
+            harness.begin()
+            harness.charm._state.k8s_auth_expiry = float("inf")
+            instance = Mock(**{
+                "get.return_value": {"metadata": {"resourceVersion": "1"}},
+                "apply.return_value": {"metadata": {"resourceVersion": "1"}},
+            })
+            # a client takes a while to create, long enough for every worker to race for it
+            with patch("k8s.Client", side_effect=lambda **_: time.sleep(0.05) or instance) as client:
+                harness.charm._apply_k8s_by_config(harness.charm._config)
+        client.assert_called_once()
+
 
-    def test_config_changed(self):
-        self.assertEqual(list(self.harness.charm._stored.things), [])
-        self.harness.update_config({"thing": "foo"})
-        self.assertEqual(list(self.harness.charm._stored.things), ["foo"])
-
-    def test_action(self):
-        # the harness doesn't (yet!) help much with actions themselves
-        action_event = Mock(params={"fail": ""})
-        self.harness.charm._on_fortune_action(action_event)
-
-        self.assertTrue(action_event.set_results.called)
-
-    def test_action_fail(self):
-        action_event = Mock(params={"fail": "fail this"})
-        self.harness.charm._on_fortune_action(action_event)
-
-        self.assertEqual(action_event.fail.call_args, [("fail this",)])
-
-    def test_httpbin_pebble_ready(self):
-        # Check the initial Pebble plan is empty
-        initial_plan = self.harness.get_container_pebble_plan("httpbin")
-        self.assertEqual(initial_plan.to_yaml(), "{}\n")
-        # Expected plan after Pebble ready with default config
-        expected_plan = {
-            "services": {
-                "httpbin": {
-                    "override": "replace",
-                    "summary": "httpbin",
-                    "command": "gunicorn -b 0.0.0.0:80 httpbin:app -k gevent",
-                    "startup": "enabled",
-                    "environment": {"thing": "🎁"},
-                }
-            },
+class TestK8sAuth(CharmTestCase):
+    leader = False
+    k8s_authorized = False
+
+    def test_permissions_cached(self):
+        self.client.access_allowed.return_value = True
+        self.assertTrue(self.harness.charm._k8s_auth())
+        calls = self.client.access_allowed.call_count
+        self.assertTrue(self.harness.charm._k8s_auth())
+        self.assertEqual(self.client.access_allowed.call_count, calls)
+        self.client.get.assert_not_called()
+
+    def test_denied_is_not_cached(self):
+        self.client.access_allowed.return_value = False
+        self.assertFalse(self.harness.charm._k8s_auth())
+        self.assertFalse(self.harness.charm._k8s_auth())
+        self.assertEqual(self.client.access_allowed.call_count, 2 * len(charm.K8S_PERMISSIONS))
+
+
+class TestK8sApply(CharmTestCase):
+    leader = False
+
+    def setUp(self):
+        super().setUp()
+        self.service_path = "/api/v1/namespaces/portainer-model/services/portainer"
+
+    def service_applies(self) -> list:
+        return [c.args[1] for c in self.client.apply.call_args_list if c.args[0] == self.service_path]
+
+    def test_unchanged_service_is_not_written(self):
+        charm = self.harness.charm
+        charm._apply_k8s_by_config(charm._config)
+        self.assertEqual(self.client.apply.call_count, 3)
+        charm._apply_k8s_by_config(charm._config)
+        self.assertEqual(self.client.apply.call_count, 3)
+
+    def test_server_defaults_are_not_drift(self):
+        charm = self.harness.charm
+        charm._apply_k8s_by_config(charm._config)
+        live = charm._build_k8s_service_by_config(charm._config)
+        live["metadata"]["resourceVersion"] = "2"
+        live["spec"]["clusterIP"] = "10.0.0.1"
+        live["status"] = {"loadBalancer": {}}
+        self.client.get.side_effect = lambda path: live if path == self.service_path else {
+            "metadata": {"resourceVersion": "1"}}
+        charm._apply_k8s_by_config(charm._config)
+        self.assertEqual(len(self.service_applies()), 1)
+        self.assertEqual(charm._state.k8s_resources["service"]["resource_version"], "2")
+
+    def test_traffic_options(self):
+        charm = self.harness.charm
+        config = {
+            **charm._config,
+            "service_external_traffic_policy": "Local",
+            "service_internal_traffic_policy": "Local",
+            "service_session_affinity": "ClientIP",
+            "service_session_affinity_timeout": 3600,
+            "service_annotations": "service.beta.kubernetes.io/aws-load-balancer-type=nlb, a=b",
         }
-        # Get the httpbin container from the model
-        container = self.harness.model.unit.get_container("httpbin")
-        # Emit the PebbleReadyEvent carrying the httpbin container
-        self.harness.charm.on.httpbin_pebble_ready.emit(container)
-        # Get the plan now we've run PebbleReady
-        updated_plan = self.harness.get_container_pebble_plan("httpbin").to_dict()
-        # Check we've got the plan we expected
-        self.assertEqual(expected_plan, updated_plan)
-        # Check the service was started
-        service = self.harness.model.unit.get_container("httpbin").get_service("httpbin")
+        service = charm._build_k8s_service_by_config(config)
+        self.assertEqual(service["metadata"]["annotations"], {
+            "service.beta.kubernetes.io/aws-load-balancer-type": "nlb",
+            "a": "b",
+        })
+        self.assertEqual(service["spec"]["externalTrafficPolicy"], "Local")
+        self.assertEqual(service["spec"]["internalTrafficPolicy"], "Local")
+        self.assertEqual(service["spec"]["sessionAffinityConfig"]["clientIP"]["timeoutSeconds"], 3600)
+        cluster_ip = charm._build_k8s_service_by_config({**config, "service_type": "ClusterIP"})
+        self.assertNotIn("externalTrafficPolicy", cluster_ip["spec"])
+        self.assertNotIn("annotations", charm._build_k8s_service_by_config(charm._config)["metadata"])
+        charm._apply_k8s_by_config(config)
+        self.assertEqual(self.service_applies(), [service])
+
+    def test_invalid_annotation_key(self):
+        charm = self.harness.charm
+        self.assertTrue(charm._validate_config({**charm._config, "service_annotations": "example.com/a_b=c"}))
+        for annotations in ("not a key=x", "Example.com/a=b", "/a=b", "a/b/c=d"):
+            self.assertFalse(charm._validate_config({**charm._config, "service_annotations": annotations}))
+
+    def test_changed_service_is_applied(self):
+        charm = self.harness.charm
+        charm._apply_k8s_by_config(charm._config)
+        charm._apply_k8s_by_config({**charm._config, "service_type": "ClusterIP"})
+        self.assertEqual([s["spec"]["type"] for s in self.service_applies()], ["LoadBalancer", "ClusterIP"])
+        self.assertNotIn(self.service_path, [c.args[0] for c in self.client.get.call_args_list])
+
+
+class TestPebble(CharmTestCase):
+    def test_portainer_pebble_ready(self):
+        self.harness.container_pebble_ready("portainer")
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertEqual(plan["services"]["portainer"]["command"], "/portainer")
+        service = self.harness.model.unit.get_container("portainer").get_service("portainer")
         self.assertTrue(service.is_running())
-        # Ensure we set an ActiveStatus with no message
         self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_noop_config_change_does_not_restart(self):
+        self.harness.container_pebble_ready("portainer")
+        container = self.harness.model.unit.get_container("portainer")
+        with patch.object(type(container), "replan") as replan, \
+                patch.object(type(container), "stop") as stop, \
+                patch.object(type(container), "restart") as restart:
+            self.harness.update_config({"service_http_port": 9000})
+            self.harness.update_config({"service_http_port": 9443})
+        replan.assert_not_called()
+        stop.assert_not_called()
+        restart.assert_not_called()
+
+    def test_node_port_change_replans(self):
+        self.harness.container_pebble_ready("portainer")
+        container = self.harness.model.unit.get_container("portainer")
+        with patch.object(type(container), "replan", autospec=True) as replan:
+            self.harness.update_config({"service_type": "NodePort", "service_edge_node_port": 30776})
+        replan.assert_called_once()
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertEqual(plan["services"]["portainer"]["command"], "/portainer --tunnel-port 30776")
+
+    def test_dispatch_is_instrumented(self):
+        self.harness.container_pebble_ready("portainer")
+        recorder = self.harness.charm._recorder
+        self.assertEqual(recorder.calls["pebble"]["replan"]["count"], 1)
+        self.assertIn("_reconcile:portainer_pebble_ready", recorder.handlers)
+        with self.assertLogs("instrumentation", level="INFO") as logs:
+            self.harness.charm._on_commit(None)
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["dispatch_metrics"]["calls"]["pebble"]["replan"]["count"], 1)
+
+    def test_go_runtime_sized_from_limits(self):
+        self.harness.container_pebble_ready("portainer")
+        self.harness.update_config({"workload_cpu_limit": "1500m", "workload_memory_limit": "1Gi", "go_gc": "200"})
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertEqual(plan["services"]["portainer"]["environment"], {
+            "GOMAXPROCS": "2",
+            "GOMEMLIMIT": str(int(2 ** 30 * 0.9)),
+            "GOGC": "200",
+        })
+        paths = [c.args[0] for c in self.harness.charm._k8s_client.apply.call_args_list]
+        self.assertIn("/apis/apps/v1/namespaces/portainer-model/statefulsets/portainer", paths)
+
+    def test_invalid_workload_config(self):
+        validate = self.harness.charm._validate_config
+        config = dict(self.harness.model.config)
+        self.assertTrue(validate(config))
+        self.assertFalse(validate({**config, "workload_cpu_limit": "two"}))
+        self.assertFalse(validate({**config, "workload_memory_request": "2Gi", "workload_memory_limit": "1Gi"}))
+        self.assertFalse(validate({**config, "go_mem_limit": "1GB"}))
+        self.assertFalse(validate({**config, "go_gc": "fast"}))
+
+    def test_edge_fleet_flags(self):
+        self.harness.container_pebble_ready("portainer")
+        container = self.harness.model.unit.get_container("portainer")
+        with patch.object(type(container), "replan", autospec=True) as replan:
+            self.harness.update_config({"snapshot_interval": "15m", "log_level": "WARN"})
+        replan.assert_called_once()
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertEqual(
+            plan["services"]["portainer"]["command"],
+            "/portainer --snapshot-interval 15m --log-level WARN")
+        config = dict(self.harness.model.config)
+        self.assertFalse(self.harness.charm._validate_config({**config, "snapshot_interval": "15"}))
+        self.assertFalse(self.harness.charm._validate_config({**config, "log_level": "TRACE"}))
+
+    def test_health_checks(self):
+        self.harness.update_config({"health_check_period": "30s", "health_check_threshold": 5})
+        self.harness.container_pebble_ready("portainer")
+        plan = self.harness.get_container_pebble_plan("portainer").to_dict()
+        self.assertEqual(plan["checks"]["portainer-ready"]["http"], {"url": "http://localhost:9000/api/system/status"})
+        self.assertEqual(plan["checks"]["portainer-ready"]["period"], "30s")
+        self.assertEqual(plan["checks"]["portainer-ready"]["threshold"], 5)
+        # the checks that restart portainer outlast a migration whatever the options say
+        for name in ("portainer-alive", "portainer-edge"):
+            self.assertEqual(plan["checks"][name]["threshold"], 20)
+        self.assertEqual(plan["services"]["portainer"]["on-check-failure"], {
+            "portainer-alive": "restart",
+            "portainer-edge": "restart",
+        })
+        validate = self.harness.charm._validate_config
+        config = dict(self.harness.model.config)
+        self.assertFalse(validate({**config, "health_check_timeout": "3"}))
+        self.assertFalse(validate({**config, "health_check_timeout": "0s"}))
+        self.assertFalse(validate({**config, "health_check_period": "0s"}))
+        self.assertFalse(validate({**config, "health_check_timeout": "30s"}))
+        self.assertFalse(validate({**config, "health_check_period": "1m", "health_check_timeout": "1m"}))
+        self.assertTrue(validate({**config, "health_check_period": "1m", "health_check_timeout": "59.5s"}))
+        self.assertFalse(validate({**config, "health_check_threshold": 0}))
+
+    def test_status_follows_health_checks(self):
+        self.harness.container_pebble_ready("portainer")
+        container = self.harness.model.unit.get_container("portainer")
+        down = pebble.CheckInfo("portainer-ready", pebble.CheckLevel.READY, pebble.CheckStatus.DOWN, failures=3)
+        with patch.object(type(container), "get_checks", return_value={"portainer-ready": down}):
+            self.harness.charm.on.portainer_pebble_check_failed.emit(container, "portainer-ready")
+        self.assertEqual(self.harness.model.unit.status.message, "portainer portainer-ready check is down")
+        self.harness.charm.on.portainer_pebble_check_recovered.emit(container, "portainer-ready")
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_failures_below_threshold_keep_active(self):
+        self.harness.container_pebble_ready("portainer")
+        container = self.harness.model.unit.get_container("portainer")
+        failing = pebble.CheckInfo("portainer-ready", pebble.CheckLevel.READY, pebble.CheckStatus.UP, failures=1)
+        with patch.object(type(container), "get_checks", return_value={"portainer-ready": failing}):
+            self.harness.charm.on.portainer_pebble_check_failed.emit(container, "portainer-ready")
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_update_status_refreshes_health_checks(self):
+        self.harness.container_pebble_ready("portainer")
+        patcher = patch.object(self.harness.charm, "_check_k8s_drift")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        container = self.harness.model.unit.get_container("portainer")
+        down = pebble.CheckInfo("portainer-alive", pebble.CheckLevel.ALIVE, pebble.CheckStatus.DOWN, failures=3)
+        with patch.object(type(container), "get_checks", return_value={"portainer-alive": down}):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status.message, "portainer portainer-alive check is down")
+        # recovered without a check-recovered event, as after a restart by pebble
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_converged_config_change_skips_k8s(self):
+        self.harness.container_pebble_ready("portainer")
+        client = self.harness.charm._k8s_client
+        client.reset_mock()
+        self.harness.update_config({"service_http_port": 9000})
+        self.assertEqual(client.method_calls, [])
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_non_leader_waits_for_leadership(self):
+        self.harness.set_leader(False)
+        self.harness.container_pebble_ready("portainer")
+        self.assertEqual(self.harness.model.unit.status.name, "waiting")
+        service = self.harness.model.unit.get_container("portainer").get_service("portainer")
+        self.assertTrue(service.is_running())
+
+
+class TestRetry(CharmTestCase):
+    leader = False
+    k8s_authorized = False
+
+    def setUp(self):
+        super().setUp()
+        self.client.access_allowed.return_value = True
+        self.client.apply.side_effect = k8s.ApiError(503, "Service Unavailable")
+
+    def test_transient_error_backs_off(self):
+        self.harness.set_leader(True)
+        self.assertEqual(self.harness.model.unit.status.name, "waiting")
+        self.assertEqual(self.harness.charm._state.retry_attempts, 1)
+        self.assertGreater(self.harness.charm._state.retry_not_before, 0)
+        # re-runs inside the backoff window don't touch the API server
+        self.client.reset_mock()
+        self.harness.update_config({"service_http_port": 9000})
+        self.assertEqual(self.client.method_calls, [])
+
+    def test_retry_after_backoff(self):
+        self.harness.set_leader(True)
+        self.harness.charm._state.retry_not_before = 0
+        self.client.apply.side_effect = None
+        self.client.apply.return_value = {"metadata": {"resourceVersion": "1"}}
+        self.harness.update_config({"service_http_port": 9000})
+        self.assertEqual(self.harness.charm._state.retry_attempts, 0)
+        self.assertNotEqual(self.harness.charm._state.k8s_converged, "")
+
+    def test_missing_trust_does_not_back_off(self):
+        self.client.access_allowed.return_value = False
+        self.client.apply.side_effect = None
+        self.harness.set_leader(True)
+        for _ in range(7):
+            self.harness.charm.on.config_changed.emit()
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(charm.TRUST_MESSAGE))
+        self.assertEqual(self.harness.charm._state.retry_attempts, 0)
+        self.client.apply.assert_not_called()
+        # juju trust triggers a config-changed, which applies right away
+        self.client.access_allowed.return_value = True
+        self.harness.charm.on.config_changed.emit()
+        self.client.apply.assert_called()
+        self.assertNotEqual(self.harness.charm._state.k8s_converged, "")
+
+    def test_backoff_keeps_blocked_status(self):
+        self.harness.set_leader(True)
+        self.assertGreater(self.harness.charm._state.retry_not_before, time.time())
+        self.harness.charm.unit.status = BlockedStatus(charm.TRUST_MESSAGE)
+        self.harness.charm.on.config_changed.emit()
+        self.assertEqual(self.harness.model.unit.status, BlockedStatus(charm.TRUST_MESSAGE))
+
+    def test_fatal_error_raises(self):
+        self.client.apply.side_effect = k8s.ApiError(422, "Unprocessable Entity")
+        with self.assertRaises(k8s.ApiError):
+            self.harness.set_leader(True)
+
+    def test_budget_is_enforced(self):
+        client = k8s.Client(host="http://127.0.0.1:1", budget=0)
+        with self.assertRaises(k8s.BudgetExhausted) as raised:
+            client.get("/api")
+        self.assertTrue(raised.exception.transient)
+
+    def test_parallel_failures_are_aggregated(self):
+        def transient():
+            raise k8s.ApiError(503, "Service Unavailable", retry_after=30)
+
+        def fatal():
+            raise k8s.ApiError(422, "Unprocessable Entity")
+
+        with self.assertRaises(k8s.ApiError) as raised:
+            self.harness.charm._run_k8s_tasks({"service": transient, "serviceaccount": fatal, "ok": lambda: 1})
+        self.assertEqual(raised.exception.status, 422)
+        self.assertEqual(raised.exception.retry_after, 30)
+        self.assertIn("service, serviceaccount", raised.exception.reason)
+
+
+class TestBackup(CharmTestCase):
+    leader = False
+
+    def setUp(self):
+        super().setUp()
+        self.harness.container_pebble_ready("portainer")
+        self.container = self.harness.model.unit.get_container("portainer")
+        self.container.push("/data/portainer.db", b"bolt" * 100000, make_dirs=True)
+        self.container.push("/data/certs/cert.pem", b"cert", make_dirs=True)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_backup_and_restore(self):
+        archive = os.path.join(self.tmp, "portainer.tar.gz")
+        with patch.object(type(self.container), "stop", autospec=True) as stop:
+            output = self.harness.run_action("backup", {"path": archive})
+        stop.assert_called_once()
+        self.assertEqual(output.results["files"], 2)
+        self.assertEqual(self.harness.charm._recorder.calls["pebble"]["pull"]["count"], 2)
+        self.assertTrue(os.path.exists(archive))
+
+        self.container.push("/data/portainer.db", b"corrupted")
+        self.container.push("/data/stale", b"stale")
+        output = self.harness.run_action("restore", {"path": archive, "sha256": output.results["sha256"]})
+        self.assertEqual(output.results["files"], 2)
+        self.assertEqual(self.container.pull("/data/portainer.db", encoding=None).read(), b"bolt" * 100000)
+        self.assertEqual(self.container.pull("/data/certs/cert.pem").read(), "cert")
+        self.assertFalse(self.container.exists("/data/stale"))
+        self.assertTrue(self.container.get_service("portainer").is_running())
+
+    def test_failed_backup_leaves_no_archive(self):
+        archive = os.path.join(self.tmp, "portainer.tar.gz")
+        with patch("backup._spool", side_effect=pebble.PathError("generic-file-error", "read failed")):
+            with self.assertRaises(ActionFailed):
+                self.harness.run_action("backup", {"path": archive})
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_failed_restore_keeps_portainer_stopped(self):
+        archive = os.path.join(self.tmp, "portainer.tar.gz")
+        self.harness.run_action("backup", {"path": archive})
+        with patch.object(self.container, "push", side_effect=pebble.PathError("generic-file-error", "disk full")):
+            with self.assertRaises(ActionFailed):
+                self.harness.run_action("restore", {"path": archive})
+        self.assertFalse(self.container.get_service("portainer").is_running())
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+        # later hooks don't start it on the partial data either
+        self.harness.update_config({"log_level": "DEBUG"})
+        self.harness.container_pebble_ready("portainer")
+        self.assertFalse(self.container.get_service("portainer").is_running())
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+        self.harness.run_action("restore", {"path": archive})
+        self.assertTrue(self.container.get_service("portainer").is_running())
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_restore_rejects_corrupted_archive(self):
+        archive = os.path.join(self.tmp, "portainer.tar.gz")
+        output = self.harness.run_action("backup", {"path": archive})
+        with self.assertRaises(ActionFailed):
+            self.harness.run_action("restore", {"path": archive, "sha256": "0" * 64})
+        self.assertEqual(self.container.pull("/data/portainer.db", encoding=None).read(), b"bolt" * 100000)
+        self.assertEqual(len(output.results["sha256"]), 64)
+
+    def test_restore_rejects_escaping_member(self):
+        archive = os.path.join(self.tmp, "evil.tar.gz")
+        content = b"evil"
+        sums = f"{hashlib.sha256(content).hexdigest()}  ../evil\n".encode("utf-8")
+        with tarfile.open(archive, "w:gz") as tar:
+            for name, data in (("../evil", content), ("SHA256SUMS", sums)):
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                tar.addfile(member, io.BytesIO(data))
+        with patch.object(type(self.container), "stop", autospec=True) as stop:
+            with self.assertRaises(ActionFailed):
+                self.harness.run_action("restore", {"path": archive})
+        stop.assert_not_called()
+        self.assertEqual(self.container.pull("/data/portainer.db", encoding=None).read(), b"bolt" * 100000)
+        self.assertTrue(self.container.get_service("portainer").is_running())
+
+
+class TestCompactDatabase(CharmTestCase):
+    leader = False
+
+    def setUp(self):
+        super().setUp()
+        self.harness.container_pebble_ready("portainer")
+        self.container = self.harness.model.unit.get_container("portainer")
+        self.container.push("/data/portainer.db", b"bolt" * 1000, make_dirs=True)
+        self.root = self.harness.get_filesystem_root("portainer")
+        self.commands = []
+
+        def bbolt(args):
+            self.commands.append(args.command[1])
+            if args.command[1] == "compact":
+                (self.root / args.command[3].lstrip("/")).write_bytes(b"bolt")
+            return testing.ExecResult()
+
+        self.harness.handle_exec("portainer", ["bbolt"], handler=bbolt)
+
+        def mv(args):
+            self.commands.append(args.command[0])
+            source, target = (self.root / path.lstrip("/") for path in args.command[2:])
+            source.replace(target)
+            return testing.ExecResult()
+
+        self.harness.handle_exec("portainer", ["mv"], handler=mv)
+
+    def test_compact_database(self):
+        output = self.harness.run_action("compact-database")
+        self.assertEqual(self.commands, ["compact", "check", "mv"])
+        self.assertEqual(output.results["size-before"], 4000)
+        self.assertEqual(output.results["size-after"], 4)
+        self.assertFalse(self.container.exists("/data/portainer.db.compact"))
+        self.assertTrue(self.container.get_service("portainer").is_running())
+        calls = self.harness.charm._recorder.calls["pebble"]
+        self.assertEqual(calls["exec"]["count"], 3)
+        self.assertIn("stop", calls)
+
+    def test_failed_check_keeps_original(self):
+        self.harness.handle_exec("portainer", ["bbolt", "check"], result=1)
+        with self.assertRaises(ActionFailed):
+            self.harness.run_action("compact-database")
+        self.assertEqual(self.container.pull("/data/portainer.db", encoding=None).read(), b"bolt" * 1000)
+        self.assertFalse(self.container.exists("/data/portainer.db.compact"))
+
+    def test_scheduled_compaction(self):
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.commands, [])
+        self.harness.update_config({"compact_interval": 24})
+        # not at whatever time the next update-status fires, but one interval later
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.commands, [])
+        later = time.time() + 24 * 3600 + 1
+        with patch("time.time", return_value=later):
+            self.harness.charm.on.update_status.emit()
+            self.assertEqual(self.commands, ["compact", "check", "mv"])
+            self.harness.charm.on.update_status.emit()
+            self.assertEqual(self.commands, ["compact", "check", "mv"])
+
+
+class TestMetrics(CharmTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = patch("charm.METRICS_DIR", self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("metrics.ensure_exporter")
+        self.ensure_exporter = patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+    def read_metrics(self):
+        with open(os.path.join(self.directory, "metrics"), "r") as f:
+            return f.read()
+
+    def test_scrape_job_published(self):
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus")
+        self.harness.add_relation_unit(relation_id, "prometheus/0")
+        app_data = self.harness.get_relation_data(relation_id, "portainer")
+        jobs = json.loads(app_data["scrape_jobs"])
+        self.assertEqual(jobs[0]["static_configs"], [{"targets": ["*:9467"]}])
+        self.assertEqual(json.loads(app_data["scrape_metadata"])["application"], "portainer")
+        unit_data = self.harness.get_relation_data(relation_id, "portainer/0")
+        self.assertEqual(unit_data["prometheus_scrape_unit_name"], "portainer/0")
+        self.assertTrue(unit_data["prometheus_scrape_unit_address"])
+
+    def test_charm_metrics_accumulate(self):
+        self.harness.add_relation("metrics-endpoint", "prometheus")
+        with patch.dict(os.environ, {"JUJU_HOOK_NAME": "config-changed"}):
+            self.harness.container_pebble_ready("portainer")
+            # the mocked client doesn't report to the recorder like k8s.Client does
+            self.harness.charm._recorder.record("k8s", "PATCH /api/v1/namespaces/x/services/portainer", 0.1, 200)
+            self.harness.charm._on_commit(None)
+            self.harness.charm._on_commit(None)
+        self.ensure_exporter.assert_called_with(self.directory)
+        text = self.read_metrics()
+        self.assertIn('portainer_charm_hook_duration_seconds_count{hook="config-changed"} 2', text)
+        self.assertIn('portainer_charm_k8s_requests_total{hook="config-changed"} 2', text)
+        self.assertIn('portainer_charm_pebble_calls_total{call="replan"} 2', text)
+        self.assertIn('portainer_check_up{check="portainer-ready"} 1', text)
+
+    def test_deferrals_counted(self):
+        self.harness.charm._k8s_client.apply.side_effect = k8s.ApiError(503, "Service Unavailable")
+        with patch.dict(os.environ, {"JUJU_HOOK_NAME": "config-changed"}):
+            self.harness.update_config({"service_http_port": 9443})
+            self.harness.charm._on_commit(None)
+        self.ensure_exporter.assert_not_called()
+        self.assertIn('portainer_charm_deferrals_total{hook="config-changed"} 1', self.read_metrics())
+
+
+class TestState(CharmTestCase):
+    leader = False
+    k8s_authorized = False
+
+    def saved_documents(self):
+        storage = self.harness.framework._storage
+        return [call.args[1]["document"] for call in storage.save_snapshot.call_args_list
+                if call.args[0].endswith("StoredStateData[_stored]") and "State[state]" in call.args[0]]
+
+    def test_unchanged_dispatch_writes_nothing(self):
+        self.harness.charm._state.k8s_auth_expiry = float("inf")
+        self.harness.set_leader(True)
+        self.harness.container_pebble_ready("portainer")
+        storage = self.harness.framework._storage
+        with patch.object(storage, "save_snapshot", wraps=storage.save_snapshot):
+            self.harness.framework.commit()
+            self.assertEqual(len(self.saved_documents()), 1)
+            document = json.loads(self.saved_documents()[0])
+            self.assertEqual(document["v"], 2)
+            # fields holding their default are left out
+            self.assertNotIn("retry_attempts", document)
+            self.harness.update_config({"service_http_port": 9000})
+            self.harness.framework.commit()
+            self.assertEqual(len(self.saved_documents()), 1)
+            self.harness.update_config({"service_http_port": 9443})
+            self.harness.framework.commit()
+            self.assertEqual(len(self.saved_documents()), 2)
+        self.assertEqual(self.harness.charm._state.changed(), [])
+
+    def test_upgrade_migrates_schema_1(self):
+        legacy = self.harness.charm._stored
+        legacy.charm_version = 0.9
+        legacy.config = {"service_http_port": 9443}
+        # the reconcile that follows would merge the current config over the migrated one
+        with patch.object(self.harness.charm, "_reconcile"):
+            self.harness.charm.on.upgrade_charm.emit()
+        state = self.harness.charm._state
+        self.assertEqual(state.charm_version, 1.0)
+        self.assertEqual(state.config["service_http_port"], 9443)
+        self.assertEqual(state.version, None)
+        self.harness.framework.commit()
+        self.assertEqual(state.version, 2)
+
+    def test_version_is_read_with_the_document(self):
+        state = self.harness.charm._state
+        state._stored.document = '{"v":2,"charm_version":1.0}'
+        # as in a fresh dispatch, where nothing read a field yet
+        object.__setattr__(state, "_values", None)
+        self.assertEqual(state.version, 2)
+
+
+class TestIngress(CharmTestCase):
+    def setUp(self):
+        super().setUp()
+        self.harness.update_config({"service_type": "ClusterIP"})
+        self.relation_id = self.harness.add_relation("ingress", "ingress")
+        self.harness.add_relation_unit(self.relation_id, "ingress/0")
+
+    def test_http_port_published(self):
+        self.assertEqual(self.harness.get_relation_data(self.relation_id, "portainer"), {
+            "service-hostname": "portainer",
+            "service-name": "portainer",
+            "service-namespace": "portainer-model",
+            "service-port": "9000",
+        })
+        service = self.harness.charm._build_k8s_service_by_config(self.harness.charm._config)
+        self.assertEqual(service["spec"]["type"], "ClusterIP")
+        # the edge tunnel stays on the service as direct TCP
+        self.assertEqual([p["port"] for p in service["spec"]["ports"]], [9000, 8000])
+
+    def test_tls_offload(self):
+        self.harness.update_config({
+            "ingress_hostname": "portainer.example.com",
+            "ingress_tls_secret_name": "portainer-tls",
+            "service_http_port": 9080,
+        })
+        data = self.harness.get_relation_data(self.relation_id, "portainer")
+        self.assertEqual(data["service-hostname"], "portainer.example.com")
+        self.assertEqual(data["tls-secret-name"], "portainer-tls")
+        self.assertEqual(data["service-port"], "9080")
+        self.harness.update_config({"ingress_tls_secret_name": ""})
+        self.assertNotIn("tls-secret-name", self.harness.get_relation_data(self.relation_id, "portainer"))